@@ -1,5 +1,9 @@
+import os
 from utils.db_setup import setup_databases
-from utils.dbms_utils import get_clients, get_dbms_dbs, split_query, handle_query
+from utils.connections import close_all
+from utils.dbms_utils import get_dbms_dbs, split_query, handle_query
+from utils.user_directory import user_directory
+from utils.popular_rank import popular_rank_scheduler
 
 def setup():
     """Setup the databases."""
@@ -9,6 +13,10 @@ def setup():
         data_output_dir='data/database/articles', 
         data_partitioned_dir='data/database/partitioned', 
         dat_files_output_dir='data/database/dat_files',
+        generation_workers=os.cpu_count() or 1,
+        generation_seed=70240063,
+        media_mode='hardlink',
+        be_read_workers=os.cpu_count() or 1,
     )
 
 # Main loop for user interaction
@@ -23,10 +31,16 @@ def main():
             print("Database setup failed. Exiting.")
             exit(1)
 
+        # Warm the uid -> region directory used to route Read inserts
+        print(f"Loaded {user_directory.warm(dbms1_db, dbms2_db)} users into the user directory.")
+
+        # Keep the Popular-Rank rankings fresh in the background (POPULAR_RANK_REFRESH_SECONDS)
+        popular_rank_scheduler.start(dbms1_db, dbms2_db)
+
         # User Input Loop
         print("------------------------------------------------")
         print("Welcome to our Distributed Databse System")
-        print("Available commands: status, find, find_top_articles, find_articles_read, update, delete, insert, join, exit.")
+        print("Available commands: status, find, find_top_articles, find_articles_read, top, aggregate, update, delete, insert, join, explain, exit.")
         print("------------------------------------------------")
 
         while usr_inp.lower() != 'exit':
@@ -36,10 +50,11 @@ def main():
             if usr_inp.lower() != 'exit':
                 handle_query(dbms1_db, dbms2_db, usr_inp)
     finally:
+        # Stop refreshing before the connections go away
+        popular_rank_scheduler.stop()
+
         # Ensure MongoDB connections are closed
-        client1, client2 = get_clients()
-        client1.close()
-        client2.close()
+        close_all()
         print("Connections closed.")
 
 if __name__ == "__main__":
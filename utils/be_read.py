@@ -0,0 +1,188 @@
+import re
+import json
+import time
+
+# Aggregation of Reads into Be-Read rows.
+#   Reads are folded one at a time into a running state per article (counts,
+#   uid sets, latest timestamp). The same states are used to build Be-Read from
+#   read.dat at setup, merged across chunks of it, and turned into $inc /
+#   $addToSet / $max deltas when reads are inserted later on.
+#   Next to every Be-Read row, on the same DBMS, the article's engagement is
+#   rolled up per day, so the popularity of any window is a sum of day buckets.
+
+# Per article, per day engagement counts (co-located with the article's Be-Read row)
+ROLLUP_COLLECTION = "Be-Read-Daily"
+
+SECONDS_PER_DAY = 86400
+
+# Read fields of the actions counted in Be-Read, and the Be-Read fields they go to
+BE_READ_ACTIONS = (
+    ("commentOrNot", "commentNum", "commentUidList"),
+    ("agreeOrNot", "agreeNum", "agreeUidList"),
+    ("shareOrNot", "shareNum", "shareUidList"),
+)
+
+# Layout the generator writes Read lines in (READ_LINE in data_generation.py). Such
+# lines are parsed with one regex match instead of a full JSON decode, which is
+# several times faster; lines in any other layout fall back to json.loads.
+READ_LINE_PATTERN = re.compile(
+    r'\{"timestamp": "(\d+)", "id": "[^"]*", "uid": "([^"]+)", "aid": "([^"]+)", "readTimeLength": "[^"]*", '
+    r'"agreeOrNot": "([01])", "commentOrNot": "([01])", "shareOrNot": "([01])"'
+)
+
+def is_set(flag):
+    # Flags are stored as "0"/"1" strings, so "0" must not count as true
+    return flag in ("1", 1, True)
+
+def parse_read_line(line):
+    """
+    (uid, aid, timestamp in seconds, (comment, agree, share)) of a Read line,
+    or None for empty lines and reads without uid or aid.
+    """
+    match = READ_LINE_PATTERN.match(line)
+    if match:
+        timestamp, uid, aid, agree, comment, share = match.groups()
+        return uid, aid, int(timestamp[:10]), (comment == "1", agree == "1", share == "1")
+
+    if not line.strip():
+        return None
+    return read_fields(json.loads(line))
+
+def read_fields(record):
+    """Like parse_read_line, for a Read document."""
+    aid = record.get('aid')
+    uid = record.get('uid')
+    if not aid or not uid:
+        return None
+    flags = tuple(is_set(record.get(flag)) for flag, _, _ in BE_READ_ACTIONS)
+    return uid, aid, int(str(record.get("timestamp", "0"))[:10]), flags
+
+def new_be_read_state():
+    """Running aggregate of one article: counts, uid sets and the latest timestamp."""
+    return {
+        "readNum": 0,
+        "readUids": set(),
+        "actionNums": [0] * len(BE_READ_ACTIONS),
+        "actionUids": [set() for _ in BE_READ_ACTIONS],
+        "timestamp": 0,
+        "days": {},  # day number -> [reads, comments, agrees, shares]
+    }
+
+def add_read(states, read):
+    """Fold one parsed read into its article's state."""
+    uid, aid, timestamp, flags = read
+    state = states.get(aid)
+    if state is None:
+        state = states[aid] = new_be_read_state()
+
+    state["readNum"] += 1
+    state["readUids"].add(uid)
+    for i, flag in enumerate(flags):
+        if flag:
+            state["actionNums"][i] += 1
+            state["actionUids"][i].add(uid)
+
+    # Keep the latest timestamp for this article
+    if timestamp > state["timestamp"]:
+        state["timestamp"] = timestamp
+
+    day_counts = state["days"].get(timestamp // SECONDS_PER_DAY)
+    if day_counts is None:
+        day_counts = state["days"][timestamp // SECONDS_PER_DAY] = [0] * (len(BE_READ_ACTIONS) + 1)
+    day_counts[0] += 1
+    for i, flag in enumerate(flags):
+        if flag:
+            day_counts[i + 1] += 1
+
+def aggregate_reads(lines, states=None):
+    """
+    Fold Read lines into aid -> running Be-Read state, one line at a time.
+    Memory grows with the number of articles and distinct readers, not with the number of reads.
+    """
+    states = {} if states is None else states
+    for line in lines:
+        read = parse_read_line(line)
+        if read is not None:  # Skip records without aid or uid
+            add_read(states, read)
+    return states
+
+def aggregate_read_documents(documents, states=None):
+    """Like aggregate_reads, for Read documents."""
+    states = {} if states is None else states
+    for document in documents:
+        read = read_fields(document)
+        if read is not None:
+            add_read(states, read)
+    return states
+
+def merge_be_read_states(states, partial_states):
+    """Merge the per article states of one chunk of reads into states."""
+    for aid, partial in partial_states.items():
+        state = states.get(aid)
+        if state is None:
+            states[aid] = partial
+            continue
+        state["readNum"] += partial["readNum"]
+        state["readUids"] |= partial["readUids"]
+        for i in range(len(BE_READ_ACTIONS)):
+            state["actionNums"][i] += partial["actionNums"][i]
+            state["actionUids"][i] |= partial["actionUids"][i]
+        state["timestamp"] = max(state["timestamp"], partial["timestamp"])
+        for day, partial_counts in partial["days"].items():
+            day_counts = state["days"].get(day)
+            if day_counts is None:
+                state["days"][day] = partial_counts
+            else:
+                for i, count in enumerate(partial_counts):
+                    day_counts[i] += count
+    return states
+
+def be_read_document(aid, state):
+    """The Be-Read document of an aggregated article, with its uid sets as sorted lists."""
+    document = {
+        "aid": aid,
+        "readNum": state["readNum"],
+        "readUidList": sorted(state["readUids"]),
+    }
+    for i, (_, count_field, list_field) in enumerate(BE_READ_ACTIONS):
+        document[count_field] = state["actionNums"][i]
+        document[list_field] = sorted(state["actionUids"][i])
+    document["timestamp"] = state["timestamp"]
+    return document
+
+
+def be_read_delta(state):
+    """
+    Update applying an article's state to its Be-Read row: counters are incremented,
+    uids added to the lists and the timestamp raised. Upserting it creates the row.
+    """
+    increments = {"readNum": state["readNum"]}
+    uid_lists = {"readUidList": {"$each": sorted(state["readUids"])}}
+    for i, (_, count_field, list_field) in enumerate(BE_READ_ACTIONS):
+        increments[count_field] = state["actionNums"][i]
+        uid_lists[list_field] = {"$each": sorted(state["actionUids"][i])}
+    return {"$inc": increments, "$addToSet": uid_lists, "$max": {"timestamp": state["timestamp"]}}
+
+def day_string(day):
+    """"YYYY-MM-DD" (UTC) of a day number (days since the epoch)."""
+    return time.strftime("%Y-%m-%d", time.gmtime(day * SECONDS_PER_DAY))
+
+def rollup_counts(day_counts):
+    counts = {"readNum": day_counts[0]}
+    for i, (_, count_field, _) in enumerate(BE_READ_ACTIONS):
+        counts[count_field] = day_counts[i + 1]
+    return counts
+
+def rollup_documents(aid, state):
+    """The per day rollup documents of an aggregated article."""
+    return [
+        {"aid": aid, "day": day_string(day), **rollup_counts(day_counts)}
+        for day, day_counts in sorted(state["days"].items())
+    ]
+
+def rollup_deltas(aid, state):
+    """(filter, update) pairs adding an article's state to its per day rollups (upserted)."""
+    return [
+        ({"aid": aid, "day": day_string(day)}, {"$inc": rollup_counts(day_counts)})
+        for day, day_counts in sorted(state["days"].items())
+    ]
@@ -0,0 +1,65 @@
+import os
+import atexit
+import threading
+from pymongo import MongoClient
+
+# Process-wide registry of MongoDB clients.
+#   Every node gets one pooled MongoClient, created on first use and shared by
+#   all of utils/ (MongoClient is thread-safe). The clients are closed at exit.
+
+# Nodes of the cluster: name -> (host, port environment variable, default port)
+NODES = {
+    "DBMS1": ("localhost", "DBMS1_PORT", 27017),  # Beijing
+    "DBMS2": ("localhost", "DBMS2_PORT", 27018),  # Hong Kong
+    "GFS": ("localhost", "GFS_PORT", 27041),      # GridFS media
+}
+
+# Options every client is created with, configurable through the environment or configure_clients
+CLIENT_OPTIONS = {
+    "maxPoolSize": int(os.getenv("MONGO_MAX_POOL_SIZE", 50)),
+    "connectTimeoutMS": int(os.getenv("MONGO_CONNECT_TIMEOUT_MS", 5000)),
+    "serverSelectionTimeoutMS": int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", 5000)),
+}
+
+_clients = {}
+_lock = threading.Lock()
+
+def node_address(node):
+    """(host, port) of a node in NODES."""
+    host, port_variable, default_port = NODES[node]
+    return host, int(os.getenv(port_variable, default_port))
+
+def get_client_at(host, port):
+    """The shared client for host:port, created on first use."""
+    key = (host, int(port))
+    client = _clients.get(key)
+    if client is None:
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                client = MongoClient(host, int(port), **CLIENT_OPTIONS)
+                _clients[key] = client
+    return client
+
+def get_client(node):
+    """The shared client of a node ("DBMS1", "DBMS2" or "GFS")."""
+    return get_client_at(*node_address(node))
+
+def configure_clients(max_pool_size=None, connect_timeout_ms=None, server_selection_timeout_ms=None):
+    """Change the client options. Clients that already exist are closed and recreated on next use."""
+    if max_pool_size is not None:
+        CLIENT_OPTIONS["maxPoolSize"] = max_pool_size
+    if connect_timeout_ms is not None:
+        CLIENT_OPTIONS["connectTimeoutMS"] = connect_timeout_ms
+    if server_selection_timeout_ms is not None:
+        CLIENT_OPTIONS["serverSelectionTimeoutMS"] = server_selection_timeout_ms
+    close_all()
+
+def close_all():
+    """Close every client in the registry."""
+    with _lock:
+        for client in _clients.values():
+            client.close()
+        _clients.clear()
+
+atexit.register(close_all)
@@ -1,20 +1,348 @@
 import json
 import random
+import hashlib
 import numpy as np
 from PIL import Image
-from shutil import copyfile
+from shutil import copyfile, copyfileobj
+from multiprocessing import Pool
 import os
 from enum import Enum
 
+# Beijing:60%   Hong Kong:40%
+# en:20%    zh:80%
+# 20 depts
+# 3 roles
+# 50 tags
+# 0~99 credits
+def gen_an_user (i, rng):
+    timeBegin = 1506328859000
+    user = {}
+    user["timestamp"] = str(timeBegin + i)
+    user["id"] = 'u'+str(i)
+    user["uid"] = str(i)
+    user["name"] = "user%d" % i
+    user["gender"] = "male" if rng.random() > 0.33 else "female"
+    user["email"] = "email%d" % i
+    user["phone"] = "phone%d" % i
+    user["dept"]  = "dept%d" % int(rng.random() * 20)
+    user["grade"] = "grade%d" % int(rng.random() * 4 + 1)
+    user["language"] = "en" if rng.random() > 0.8 else "zh"
+    user["region"] = "Beijing" if rng.random() > 0.4 else "Hong Kong"
+    user["role"] = "role%d" % int(rng.random() * 3)
+    user["preferTags"] = "tags%d" % int(rng.random() * 50)
+    user["obtainedCredits"] = str(int(rng.random() * 100))
+    return user
+
+# Cache of the bbc news listings, so every article doesn't list the directory again
+_news_files = {}
+
+def list_news_files(input_dir, category):
+    key = (input_dir, category)
+    if key not in _news_files:
+        _news_files[key] = os.listdir(f'{input_dir}/bbc_news_texts/' + category +'/')
+    return _news_files[key]
+
+# How article media is materialized:
+#   copy      - a full copy of the source file per article (the original behaviour)
+#   hardlink  - a hardlink to the blob in the content-addressed store
+#   symlink   - a symlink to the blob in the content-addressed store
+#   manifest  - no media files, the article directory gets a manifest of filename -> blob
+MEDIA_MODES = ("copy", "hardlink", "symlink", "manifest")
+MEDIA_MANIFEST = "media_manifest.json"
+
+# Cache of source file -> blob path, so every source is hashed once per process
+_store_blobs = {}
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def store_blob(src, media_store_dir):
+    """Put src into the content-addressed store (once) and return its blob path."""
+    key = (src, media_store_dir)
+    if key not in _store_blobs:
+        digest = file_sha256(src)
+        blob = os.path.join(media_store_dir, digest + os.path.splitext(src)[1])
+        # A blob that doesn't match its name anymore (written through by an earlier run) is replaced
+        if not os.path.exists(blob) or file_sha256(blob) != digest:
+            # Write under a temporary name so parallel workers never see half a blob
+            tmp = f"{blob}.{os.getpid()}.tmp"
+            copyfile(src, tmp)
+            os.replace(tmp, blob)
+        _store_blobs[key] = blob
+    return _store_blobs[key]
+
+def materialize_media(src, dest, media_mode, media_store_dir, manifest):
+    """Make the media file dest (with the content of src) available according to media_mode."""
+    # dest may be a hardlink or symlink into the store from an earlier run, writing
+    # through it would change the blob of every article sharing it
+    if os.path.lexists(dest):
+        os.remove(dest)
+
+    if media_mode == "copy":
+        copyfile(src, dest)
+        return
+
+    blob = store_blob(src, media_store_dir)
+    if media_mode == "manifest":
+        manifest[os.path.basename(dest)] = os.path.relpath(blob, os.path.dirname(dest))
+        return
+
+    if media_mode == "hardlink":
+        try:
+            os.link(blob, dest)
+        except OSError:
+            # The store is on another filesystem (or links aren't supported)
+            copyfile(blob, dest)
+    else:
+        os.symlink(os.path.abspath(blob), dest)
+
+# science:45%   technology:55%
+# en:50%    zh:50%
+# 50 tags
+# 2000 authors
+def gen_an_article (i, rng, input_dir, data_output_dir, image_probability, media_mode="copy", media_store_dir=None):
+    timeBegin = 1506000000000
+    article = {}
+    article["id"] = 'a'+str(i)
+    article["timestamp"] = str(timeBegin + i)
+    article["aid"] = str(i)
+    article["title"] = "title%d" % i
+    article["category"] = "science" if rng.random() > 0.55 else "technology"
+    article["abstract"] = "abstract of article %d" % i
+    article["articleTags"] = "tags%d" % int(rng.random() * 50)
+    article["authors"]  = "author%d" % int(rng.random() * 2000)
+    article["language"] = "en" if rng.random() > 0.5 else "zh"
+
+    # create text
+    article["text"] = "text_a"+str(i)+'.txt'
+    path = f'{data_output_dir}/article'+str(i)
+    if not os.path.exists(path):
+        os.makedirs(path, exist_ok=True)
+
+    categories = ['business', 'entertainment', 'sport', 'tech']
+    random_category = categories[rng.randint(0,3)]
+    files = list_news_files(input_dir, random_category)
+    size = len(files)
+    random_news = files[rng.randint(0,size-1)]
+    manifest = {}
+    materialize_media(f'{input_dir}/bbc_news_texts/' + random_category +'/' +random_news, path+"/text_a"+str(i)+'.txt', media_mode, media_store_dir, manifest)
+
+
+    # create images
+    image_num = rng.randint(1,3)
+    image_str = ""
+    for j in range(image_num):
+        image_str+= 'image_a'+str(i)+'_'+str(j)+'.jpg,'
+    article["image"] = image_str
+
+    for j in range(image_num):
+        materialize_media(f'{input_dir}/image/' + str(rng.randint(0,599))+'.jpg',path+'/image_a'+str(i)+'_'+str(j)+'.jpg', media_mode, media_store_dir, manifest)
+
+    # create video
+    if rng.random() < image_probability:
+        #has one video
+        article["video"] = "video_a"+str(i)+'_video.flv'
+        if rng.random()<0.5:
+            materialize_media(f'{input_dir}/video/video1.flv',path+"/video_a"+str(i)+'_video.flv', media_mode, media_store_dir, manifest)
+        else:
+            materialize_media(f'{input_dir}/video/video2.flv',path+"/video_a"+str(i)+'_video.flv', media_mode, media_store_dir, manifest)
+    else:
+        article["video"] = ""
+
+    if media_mode == "manifest":
+        with open(f"{path}/{MEDIA_MANIFEST}", "w") as f:
+            json.dump(manifest, f)
+
+    return article
+
+# user in Beijing read/agree/comment/share an english article with the probability 0.6/0.2/0.2/0.1
+# user in Hong Kong read/agree/comment/share an Chinese article with the probability 0.8/0.2/0.2/0.1
+p = {}
+p["Beijing"+"en"] = [0.6,0.2,0.2,0.1]
+p["Beijing"+"zh"] = [1,0.3,0.3,0.2]
+p["Hong Kong"+"en"] = [1,0.3,0.3,0.2]
+p["Hong Kong"+"zh"] = [0.8,0.2,0.2,0.1]
+REGIONS = ["Beijing", "Hong Kong"]
+LANGUAGES = ["en", "zh"]
+
+# Number of candidate reads drawn per block
+READ_BATCH_SIZE = 65536
+
+# Same layout (and json.dump separators) as the old dict based records
+READ_LINE = (
+    '{"timestamp": "%d", "id": "r%d", "uid": "%d", "aid": "%d", "readTimeLength": "%d", '
+    '"agreeOrNot": "%d", "commentOrNot": "%d", "shareOrNot": "%d", '
+    '"commentDetail": "comments to this article: (%d,%d)"}\n'
+)
+
+def read_probability_table():
+    """p as an array indexed by [region, language, action]."""
+    return np.array([[p[region + lang] for lang in LANGUAGES] for region in REGIONS])
+
+def gen_reads (start, stop, rng, region_codes, language_codes, f, batch_size=READ_BATCH_SIZE):
+    """
+    Write reads [start, stop) to f as NDJSON.
+
+    region_codes[uid] and language_codes[aid] index into REGIONS and LANGUAGES.
+    Candidate (uid, aid) pairs are drawn a block at a time and kept with the read
+    probability of their region/language pair. Rejected candidates don't use up a
+    read id, so every id gets exactly one accepted read, like the old per-record
+    retry, and the timestamps stay timeBegin + i*10000.
+    """
+    timeBegin = 1506332297000
+    table = read_probability_table()
+    num_users = len(region_codes)
+    num_articles = len(language_codes)
+
+    i = start
+    while i < stop:
+        uids = (rng.random(batch_size) * num_users).astype(np.int64)
+        aids = (rng.random(batch_size) * num_articles).astype(np.int64)
+        ps = table[region_codes[uids], language_codes[aids]]
+
+        # Keep the candidates that are actually read
+        accepted = rng.random(batch_size) <= ps[:, 0]
+        uids = uids[accepted][:stop - i]
+        aids = aids[accepted][:stop - i]
+        ps = ps[accepted][:stop - i]
+        n = len(uids)
+
+        ids = np.arange(i, i + n, dtype=np.int64)
+        timestamps = timeBegin + ids * 10000
+        read_time_lengths = (rng.random(n) * 100).astype(np.int64)
+        agree = rng.random(n) < ps[:, 1]
+        comment = rng.random(n) < ps[:, 2]
+        share = rng.random(n) < ps[:, 3]
+
+        uids = uids.tolist()
+        aids = aids.tolist()
+        f.write("".join(
+            READ_LINE % row for row in zip(
+                timestamps.tolist(), ids.tolist(), uids, aids, read_time_lengths.tolist(),
+                agree.tolist(), comment.tolist(), share.tolist(), uids, aids,
+            )
+        ))
+        i += n
+
+# --------------- Sharded generation ---------------
+
+def shard_seed(seed, kind, shard):
+    """Derive a deterministic 64-bit seed for one shard of one record kind."""
+    digest = hashlib.sha256(f"{seed}:{kind}:{shard}".encode()).digest()
+    return int.from_bytes(digest[:8], "little")
+
+def shard_rng(seed, kind, shard):
+    """Random generator for a shard. Without a seed the shard is not reproducible."""
+    if seed is None:
+        return random.Random()
+    return random.Random(shard_seed(seed, kind, shard))
+
+def shard_numpy_rng(seed, kind, shard):
+    """NumPy generator for a shard, seeded like shard_rng."""
+    if seed is None:
+        return np.random.default_rng()
+    return np.random.default_rng(shard_seed(seed, kind, shard))
+
+def shard_ranges(total, shards):
+    """Split range(total) into `shards` contiguous (start, stop) ranges."""
+    step, rest = divmod(total, shards)
+    ranges = []
+    start = 0
+    for shard in range(shards):
+        stop = start + step + (1 if shard < rest else 0)
+        ranges.append((start, stop))
+        start = stop
+    return ranges
+
+def shard_path(path, shard):
+    return f"{path}.part{shard:03d}"
+
+def generate_user_shard(args):
+    """Write users [start, stop) to a shard file and return their uid -> region."""
+    shard, start, stop, seed, path = args
+    rng = shard_rng(seed, "user", shard)
+    uid_region = {}
+    with open(path, "w+") as f:
+        for i in range(start, stop):
+            user = gen_an_user(i, rng)
+            uid_region[user["uid"]] = user["region"]
+            json.dump(user, f)
+            f.write("\n")
+    return uid_region
+
+def generate_article_shard(args):
+    """Write articles [start, stop) (and their media) to a shard file and return their aid -> language."""
+    shard, start, stop, seed, path, input_dir, data_output_dir, image_probability, media_mode, media_store_dir = args
+    rng = shard_rng(seed, "article", shard)
+    aid_lang = {}
+    with open(path, "w+") as f:
+        for i in range(start, stop):
+            article = gen_an_article(i, rng, input_dir, data_output_dir, image_probability, media_mode, media_store_dir)
+            aid_lang[article["aid"]] = article["language"]
+            json.dump(article, f)
+            f.write("\n")
+    return aid_lang
+
+# Lookups shared by the read workers, set once per process by init_read_worker
+_read_lookups = {}
+
+def init_read_worker(region_codes, language_codes):
+    _read_lookups["region_codes"] = region_codes
+    _read_lookups["language_codes"] = language_codes
+
+def generate_read_shard(args):
+    """Write reads [start, stop) to a shard file and return how many were written."""
+    shard, start, stop, seed, path = args
+    rng = shard_numpy_rng(seed, "read", shard)
+    with open(path, "w+") as f:
+        gen_reads(start, stop, rng, _read_lookups["region_codes"], _read_lookups["language_codes"], f)
+    return stop - start
+
+def merge_shards(part_paths, path):
+    """Concatenate the shard files (in shard order) into one file and remove the parts."""
+    with open(path, "wb") as out:
+        for part_path in part_paths:
+            with open(part_path, "rb") as part:
+                copyfileobj(part, out, 1024 * 1024)
+            os.remove(part_path)
+
+def run_shards(pool, func, jobs):
+    """Run the shard jobs in the pool (or in this process without one), keeping shard order."""
+    if pool is None:
+        return [func(job) for job in jobs]
+    return pool.map(func, jobs)
+
 def generate_data(
-        num_users=10000, 
-        num_articles=10000, 
-        num_reads=1000000, 
-        input_dir='data/raw', 
-        data_output_dir='data/database/articles', 
-        dat_files_output_dir='data/database/dat_files', 
-        gb_size=10):
-    
+        num_users=10000,
+        num_articles=10000,
+        num_reads=1000000,
+        input_dir='data/raw',
+        data_output_dir='data/database/articles',
+        dat_files_output_dir='data/database/dat_files',
+        gb_size=10,
+        workers=1,
+        seed=None,
+        merge_parts=True,
+        media_mode="copy",
+        media_store_dir=None):
+    """
+    Generate user.dat, article.dat and read.dat.
+
+    Each id range is split into `workers` shards, every shard gets its own
+    generator seeded from (seed, kind, shard), and the shards are written in
+    parallel by a process pool. Given the same seed and worker count the output
+    is identical. With merge_parts the shard files are concatenated into the
+    .dat files, otherwise they are kept as numbered parts (user.dat.part000, ...).
+
+    media_mode picks how article media is materialized (see MEDIA_MODES). All
+    modes but "copy" keep a single copy of every source file in media_store_dir,
+    by default a "media_store" directory next to data_output_dir.
+    """
+
     uid_region = {}
     aid_lang = {}
 
@@ -22,155 +350,71 @@ def generate_data(
     ARTICLES_NUM = num_articles
     READS_NUM = num_reads
 
-    uid_region = {}
-    aid_lang = {}
-    
     # Depending on dataset size, choose chance of getting photo
     if([10, 50, 100].count(gb_size) == -1):
         print("Invalid dataset size. Please choose 10, 50, or 100 GB.")
         return False
-    
+
     image_probability = {
         10: 0.05,
         50: 0.4,
         100: 0.6,
     }[gb_size]
 
-    # Beijing:60%   Hong Kong:40%
-    # en:20%    zh:80%
-    # 20 depts
-    # 3 roles
-    # 50 tags
-    # 0~99 credits
-
-    def gen_an_user (i):
-        timeBegin = 1506328859000
-        user = {}
-        user["timestamp"] = str(timeBegin + i)
-        user["id"] = 'u'+str(i)
-        user["uid"] = str(i)
-        user["name"] = "user%d" % i
-        user["gender"] = "male" if random.random() > 0.33 else "female"
-        user["email"] = "email%d" % i
-        user["phone"] = "phone%d" % i
-        user["dept"]  = "dept%d" % int(random.random() * 20)
-        user["grade"] = "grade%d" % int(random.random() * 4 + 1)
-        user["language"] = "en" if random.random() > 0.8 else "zh"
-        user["region"] = "Beijing" if random.random() > 0.4 else "Hong Kong"
-        user["role"] = "role%d" % int(random.random() * 3)
-        user["preferTags"] = "tags%d" % int(random.random() * 50)
-        user["obtainedCredits"] = str(int(random.random() * 100))
-
-        uid_region[user["uid"]] = user["region"]
-        return user
-
-    # science:45%   technology:55%
-    # en:50%    zh:50%
-    # 50 tags
-    # 2000 authors
-    def gen_an_article (i):
-        timeBegin = 1506000000000
-        article = {}
-        article["id"] = 'a'+str(i)
-        article["timestamp"] = str(timeBegin + i)
-        article["aid"] = str(i)
-        article["title"] = "title%d" % i
-        article["category"] = "science" if random.random() > 0.55 else "technology"
-        article["abstract"] = "abstract of article %d" % i
-        article["articleTags"] = "tags%d" % int(random.random() * 50)
-        article["authors"]  = "author%d" % int(random.random() * 2000)
-        article["language"] = "en" if random.random() > 0.5 else "zh"
-
-        # create text
-        article["text"] = "text_a"+str(i)+'.txt'
-        path = f'{data_output_dir}/article'+str(i)
-        if not os.path.exists(path):
-            os.makedirs(path, exist_ok=True) 
-
-        categories = ['business', 'entertainment', 'sport', 'tech']
-        random_category = categories[random.randint(0,3)]
-        files = os.listdir(f'{input_dir}/bbc_news_texts/' + random_category +'/')
-        size = len(files)
-        random_news = files[random.randint(0,size-1)]
-        copyfile(f'{input_dir}/bbc_news_texts/' + random_category +'/' +random_news, path+"/text_a"+str(i)+'.txt')
-
-
-        # create images
-        image_num = random.randint(1,3)
-        image_str = ""
-        for j in range(image_num):
-            image_str+= 'image_a'+str(i)+'_'+str(j)+'.jpg,'
-        article["image"] = image_str
-    
-        for j in range(image_num):
-            copyfile(f'{input_dir}/image/' + str(random.randint(0,599))+'.jpg',path+'/image_a'+str(i)+'_'+str(j)+'.jpg')
-
-        # create video
-        if random.random() < image_probability:
-            #has one video
-            article["video"] = "video_a"+str(i)+'_video.flv'
-            if random.random()<0.5:
-                copyfile(f'{input_dir}/video/video1.flv',path+"/video_a"+str(i)+'_video.flv')
-            else:
-                copyfile(f'{input_dir}/video/video2.flv',path+"/video_a"+str(i)+'_video.flv')
-        else:
-            article["video"] = ""
-
-        aid_lang[article["aid"]] = article["language"]
-        return article
-
-    # user in Beijing read/agree/comment/share an english article with the probability 0.6/0.2/0.2/0.1
-    # user in Hong Kong read/agree/comment/share an Chinese article with the probability 0.8/0.2/0.2/0.1
-    p = {}
-    p["Beijing"+"en"] = [0.6,0.2,0.2,0.1]
-    p["Beijing"+"zh"] = [1,0.3,0.3,0.2]
-    p["Hong Kong"+"en"] = [1,0.3,0.3,0.2]
-    p["Hong Kong"+"zh"] = [0.8,0.2,0.2,0.1]
-    def gen_an_read (i):
-        timeBegin = 1506332297000
-        read = {}
-        read["timestamp"] = str(timeBegin + i*10000)
-        read["id"] = 'r'+str(i)
-        read["uid"] = str(int(random.random() * num_users))
-        read["aid"] = str(int(random.random() * num_articles))
-        
-        region = uid_region[read["uid"]]
-        lang = aid_lang[read["aid"]]
-        ps = p[region + lang]
-
-        if (random.random() > ps[0]):
-            # read["readOrNot"] = "0";
-            return gen_an_read (i)
-        else:
-            # read["readOrNot"] = "1"
-            read["readTimeLength"] = str(int(random.random() * 100))
-            # read["readSequence"] = str(int(random.random() * 4))
-            read["agreeOrNot"] = "1" if random.random() < ps[1] else "0"
-            read["commentOrNot"] = "1" if random.random() < ps[2] else "0"
-            read["shareOrNot"] = "1" if random.random() < ps[3] else "0"
-            read["commentDetail"] = "comments to this article: (" + read["uid"] + "," + read["aid"] + ")" 
-        return read
-
-    if not os.path.exists(f'/{data_output_dir}'):
-        os.makedirs(f'./{data_output_dir}', exist_ok=True)
-
-    if not os.path.exists(f'/{dat_files_output_dir}'):
-        os.makedirs(f'./{dat_files_output_dir}', exist_ok=True)
-
-    with open(f"{dat_files_output_dir}/user.dat", "w+") as f:
-        for i in range (USERS_NUM):
-            json.dump(gen_an_user(i), f)
-            f.write("\n")
+    if media_mode not in MEDIA_MODES:
+        print(f"Invalid media mode {media_mode}. Please choose one of {', '.join(MEDIA_MODES)}.")
+        return False
 
-    with open(f"{dat_files_output_dir}/article.dat", "w+") as f:
-        for i in range(ARTICLES_NUM):
-            json.dump(gen_an_article(i), f)
-            f.write("\n")
+    if media_store_dir is None:
+        media_store_dir = os.path.join(os.path.dirname(os.path.normpath(data_output_dir)), "media_store")
 
+    workers = max(1, int(workers))
 
-    with open(f"{dat_files_output_dir}/read.dat", "w+") as f:
-        for i in range(READS_NUM):
-            json.dump(gen_an_read(i), f)
-            f.write("\n")
+    os.makedirs(data_output_dir, exist_ok=True)
+    os.makedirs(dat_files_output_dir, exist_ok=True)
+    if media_mode != "copy":
+        os.makedirs(media_store_dir, exist_ok=True)
+
+    user_path = f"{dat_files_output_dir}/user.dat"
+    article_path = f"{dat_files_output_dir}/article.dat"
+    read_path = f"{dat_files_output_dir}/read.dat"
+
+    user_jobs = [
+        (shard, start, stop, seed, shard_path(user_path, shard))
+        for shard, (start, stop) in enumerate(shard_ranges(USERS_NUM, workers))
+    ]
+    article_jobs = [
+        (shard, start, stop, seed, shard_path(article_path, shard), input_dir, data_output_dir, image_probability, media_mode, media_store_dir)
+        for shard, (start, stop) in enumerate(shard_ranges(ARTICLES_NUM, workers))
+    ]
+    read_jobs = [
+        (shard, start, stop, seed, shard_path(read_path, shard))
+        for shard, (start, stop) in enumerate(shard_ranges(READS_NUM, workers))
+    ]
+
+    pool = Pool(workers) if workers > 1 else None
+    try:
+        for part in run_shards(pool, generate_user_shard, user_jobs):
+            uid_region.update(part)
+        for part in run_shards(pool, generate_article_shard, article_jobs):
+            aid_lang.update(part)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    # Reads need the complete lookups, which are handed to every worker once
+    region_codes = np.array([REGIONS.index(uid_region[str(i)]) for i in range(USERS_NUM)], dtype=np.int8)
+    language_codes = np.array([LANGUAGES.index(aid_lang[str(i)]) for i in range(ARTICLES_NUM)], dtype=np.int8)
+    if workers > 1:
+        with Pool(workers, initializer=init_read_worker, initargs=(region_codes, language_codes)) as read_pool:
+            run_shards(read_pool, generate_read_shard, read_jobs)
+    else:
+        init_read_worker(region_codes, language_codes)
+        run_shards(None, generate_read_shard, read_jobs)
+
+    if merge_parts:
+        for path, jobs in ((user_path, user_jobs), (article_path, article_jobs), (read_path, read_jobs)):
+            merge_shards([job[4] for job in jobs], path)
 
     return True
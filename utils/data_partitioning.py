@@ -1,30 +1,79 @@
 import os
 import json
 
+# Partition files are NDJSON (one document per line), so they can be written
+# and read back one document at a time instead of as one giant JSON array.
+
+# Write buffer for every partition file
+PARTITION_BUFFER_SIZE = 1024 * 1024
+
+USER_PARTITIONS = {
+    "Beijing": "user_beijing.ndjson",
+    "Hong Kong": "user_hongkong.ndjson",
+}
+ARTICLE_PARTITIONS = {
+    "science": "article_science.ndjson",
+    "technology": "article_technology.ndjson",
+}
+READ_PARTITIONS = {
+    "Beijing": "read_beijing.ndjson",
+    "Hong Kong": "read_hongkong.ndjson",
+}
+
+def iter_partition(file_path):
+    """Yield the documents of a partition file one at a time."""
+    with open(file_path, "r") as infile:
+        for line in infile:
+            if line.strip():
+                yield json.loads(line)
+
+def stream_partition(input_path, output_dir, partitions, route):
+    """
+    Read input_path once and write every line straight to the partition file
+    picked by route(record), a key of partitions (or None to drop the line).
+    Lines are written as they were read, so nothing is held besides the buffers.
+    Returns the number of documents written per partition.
+    """
+    outputs = {
+        key: open(f"{output_dir}/{file_name}", "w", buffering=PARTITION_BUFFER_SIZE)
+        for key, file_name in partitions.items()
+    }
+    counts = dict.fromkeys(partitions, 0)
+    try:
+        with open(input_path, "r") as infile:
+            for line in infile:
+                if not line.strip():
+                    continue
+                key = route(json.loads(line))
+                if key not in outputs:
+                    continue
+                if not line.endswith("\n"):
+                    line += "\n"
+                outputs[key].write(line)
+                counts[key] += 1
+    finally:
+        for out in outputs.values():
+            out.close()
+    return counts
+
 # Partition user files
 #   Users are split between Beijing and Hong Kong
-def partition_user(input_dir, output_dir):
+#   If uid_region is given it is filled with the uid -> region lookup on the way
+def partition_user(input_dir, output_dir, uid_region=None):
     os.makedirs(output_dir, exist_ok=True)
     if not (
         os.path.exists(f"{input_dir}/user.dat")):
         print("User file not found")
         return False
-    
-    with open(f"{input_dir}/user.dat", "r") as infile:
-        beijing_users = []
-        hongkong_users = []
-        for line in infile:
-            user = json.loads(line)
-            if user["region"] == "Beijing":
-                beijing_users.append(user)
-            elif user["region"] == "Hong Kong":
-                hongkong_users.append(user)
-    
-    with open(f"{output_dir}/user_beijing.json", "w") as out_bj:
-        json.dump(beijing_users, out_bj)
-    with open(f"{output_dir}/user_hongkong.json", "w") as out_hk:
-        json.dump(hongkong_users, out_hk)
 
+    if uid_region is None:
+        uid_region = {}
+
+    def route(user):
+        uid_region[user["uid"]] = user["region"]
+        return user["region"]
+
+    stream_partition(f"{input_dir}/user.dat", output_dir, USER_PARTITIONS, route)
     return True
 
 # Partition article files
@@ -36,64 +85,42 @@ def partition_article(input_dir, output_dir):
         print("Article file not found")
         return False
 
-    with open(f"{input_dir}/article.dat", "r") as infile:
-        science_articles = []
-        technology_articles = []
-        for line in infile:
-            article = json.loads(line)
-            if article["category"] == "science":
-                science_articles.append(article)
-            elif article["category"] == "technology":
-                technology_articles.append(article)
-    
-    with open(f"{output_dir}/article_science.json", "w") as out_sc:
-        json.dump(science_articles, out_sc)
-    with open(f"{output_dir}/article_technology.json", "w") as out_tech:
-        json.dump(technology_articles, out_tech)
-
+    stream_partition(f"{input_dir}/article.dat", output_dir, ARTICLE_PARTITIONS, lambda article: article["category"])
     return True
 
 # Partition the read files
 #   This is split between Beijing and Hong Kong (depending on which user who read the article)
-def partition_read(input_dir, output_dir):
+#   Without a uid_region lookup (from partition_user) it is rebuilt from the user partitions
+def partition_read(input_dir, output_dir, uid_region=None):
     os.makedirs(output_dir, exist_ok=True)
     if not (
-        os.path.exists(f"{output_dir}/user_beijing.json") and
-        os.path.exists(f"{output_dir}/user_hongkong.json")):
-        print("Partitioned user files not found")
+        os.path.exists(f"{input_dir}/read.dat")):
+        print("Read file not found")
         return False
 
-    # Load users to match region
-    with open(f"{output_dir}/user_beijing.json", "r") as infile_bj, \
-         open(f"{output_dir}/user_hongkong.json", "r") as infile_hk:
-        beijing_uids = {user["uid"] for user in json.load(infile_bj)}
-        hongkong_uids = {user["uid"] for user in json.load(infile_hk)}
+    if uid_region is None:
+        user_files = {region: f"{output_dir}/{file_name}" for region, file_name in USER_PARTITIONS.items()}
+        if not all(os.path.exists(path) for path in user_files.values()):
+            print("Partitioned user files not found")
+            return False
 
-    with open(f"{input_dir}/read.dat", "r") as infile:
-        beijing_reads = []
-        hongkong_reads = []
-        for line in infile:
-            read = json.loads(line)
-            if read["uid"] in beijing_uids:
-                beijing_reads.append(read)
-            elif read["uid"] in hongkong_uids:
-                hongkong_reads.append(read)
-    
-    with open(f"{output_dir}/read_beijing.json", "w") as out_bj:
-        json.dump(beijing_reads, out_bj)
-    with open(f"{output_dir}/read_hongkong.json", "w") as out_hk:
-        json.dump(hongkong_reads, out_hk)
+        uid_region = {}
+        for region, path in user_files.items():
+            for user in iter_partition(path):
+                uid_region[user["uid"]] = region
 
+    stream_partition(f"{input_dir}/read.dat", output_dir, READ_PARTITIONS, lambda read: uid_region.get(read["uid"]))
     return True
 
 def partition_all(input_dir="data/database/dat_files", output_dir="data/database/partitioned"):
     # Create the output directory if it doesn't exist
     os.makedirs(output_dir, exist_ok=True)
 
-    # Partition the files
-    user = partition_user(input_dir, output_dir)
+    # Partition the files, every .dat file is read exactly once
+    uid_region = {}
+    user = partition_user(input_dir, output_dir, uid_region)
     article = partition_article(input_dir, output_dir)
-    read = partition_read(input_dir, output_dir)
+    read = user and partition_read(input_dir, output_dir, uid_region)
 
     # If any of the partitioning fails, return False
     return user and article and read
@@ -1,16 +1,34 @@
 import os
-import json
 import time
+import uuid
 import subprocess
-from pymongo import MongoClient
+from concurrent.futures import ThreadPoolExecutor
+from utils.connections import get_client_at
 from utils.dbms_utils import (
     get_dbms_dbs,
     clear_all_data,
 )
 from utils.data_generation import generate_data
-from utils.data_partitioning import partition_all
-from utils.upload_media import bulk_upload_articles
+from utils.data_partitioning import (
+    partition_all,
+    iter_partition,
+    USER_PARTITIONS,
+    ARTICLE_PARTITIONS,
+    READ_PARTITIONS,
+)
+from utils.upload_media import bulk_upload_articles, count_media_files
 from utils.populate_dbs import populate_be_read_table, populate_popular_rank
+from utils.be_read import ROLLUP_COLLECTION
+from utils.popular_rank import POPULAR_RANK_LATEST
+from utils.indexes import apply_indexes, drop_indexes, list_indexes, catalog_spec
+from utils.stage_manifest import (
+    MANIFEST_DIR,
+    run_stage,
+    manifest_digest,
+    fingerprint_files,
+    fingerprint_tree,
+    count_entries,
+)
 import random
 
 def is_docker_running():
@@ -39,7 +57,7 @@ def docker_compose_up():
 def connect_to_mongodb(host, port, db_name):
     """Connects to a MongoDB instance."""
     try:
-        client = MongoClient(host, port)
+        client = get_client_at(host, port)
         db = client[db_name]
         db.list_collection_names()
         print(f"Connected to MongoDB: {host}:{port}/{db_name}")
@@ -60,41 +78,72 @@ def clear_database(db):
         print(f"Error clearing database {db.name}: {e}")
         return False
 
-# TODO USE UTILS INSTEAD
-def insert_data_into_collection(db, collection_name, file_path):
-    """Inserts data from a JSON file into a MongoDB collection."""
+# Documents per insert_many batch when loading partition files
+INSERT_BATCH_SIZE = 5000
+
+def iter_batches(documents, batch_size):
+    """Group an iterable of documents into lists of at most batch_size."""
+    batch = []
+    for document in documents:
+        batch.append(document)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def report_load_rate(target, inserted, duration):
+    rate = inserted / duration if duration > 0 else 0
+    print(f"Inserted {inserted} documents into {target} in {duration:.2f}s ({rate:.0f} docs/sec)")
+
+def insert_data_into_collection(db, collection_name, file_path, batch_size=INSERT_BATCH_SIZE):
+    """Streams a partition (NDJSON) file into a MongoDB collection in unordered batches."""
     try:
         if not os.path.exists(file_path):
             print(f"File not found: {file_path}")
             return False
-        with open(file_path, 'r') as file:
-            data = json.load(file)
-            db[collection_name].insert_many(data)
-            print(f"Inserted data into {db.name}.{collection_name}")
+
+        start = time.time()
+        inserted = 0
+        for batch in iter_batches(iter_partition(file_path), batch_size):
+            db[collection_name].insert_many(batch, ordered=False)
+            inserted += len(batch)
+
+        report_load_rate(f"{db.name}.{collection_name}", inserted, time.time() - start)
         return True
     except Exception as e:
         print(f"Error inserting data into {db.name}.{collection_name}: {e}")
         return False
 
-def distribute_science_articles(input_dir):
+def distribute_science_articles(input_dir, batch_size=INSERT_BATCH_SIZE):
     """Randomly distributes science articles between dbms1 and dbms2."""
     try:
         dbms1, dbms2 = get_dbms_dbs()  # Retrieve the two Mongo databases
-        file_path = os.path.join(input_dir, "article_science.json")
+        file_path = os.path.join(input_dir, "article_science.ndjson")
 
         if not os.path.exists(file_path):
             print(f"File not found: {file_path}")
             return False
 
-        # Load all science articles
-        with open(file_path, "r") as file:
-            articles = json.load(file)
-
-        # Iterate and randomly pick dbms1 or dbms2 for each article
-        for article in articles:
+        # Iterate and randomly pick dbms1 or dbms2 for each article, inserting per batch
+        start = time.time()
+        inserted = 0
+        batches = {dbms1.name: [], dbms2.name: []}
+        for article in iter_partition(file_path):
             chosen_db = random.choice([dbms1, dbms2])
-            chosen_db["Article"].insert_one(article)
+            batch = batches[chosen_db.name]
+            batch.append(article)
+            if len(batch) >= batch_size:
+                chosen_db["Article"].insert_many(batch, ordered=False)
+                inserted += len(batch)
+                batch.clear()
+
+        for db in (dbms1, dbms2):
+            if batches[db.name]:
+                db["Article"].insert_many(batches[db.name], ordered=False)
+                inserted += len(batches[db.name])
 
+        report_load_rate("Article (science)", inserted, time.time() - start)
         print("Successfully distributed science articles randomly across both databases.")
         return True
 
@@ -120,14 +169,12 @@ def verify_science_distribution(input_dir):
         dbms2_science_count = dbms2["Article"].count_documents({"category": "science"})
         
         # 2. Load the science articles from the file to get the total
-        file_path = os.path.join(input_dir, "article_science.json")
+        file_path = os.path.join(input_dir, "article_science.ndjson")
         if not os.path.exists(file_path):
             print(f"File not found: {file_path}")
             return False
         
-        with open(file_path, "r") as file:
-            articles = json.load(file)
-        total_science_count = len(articles)
+        total_science_count = sum(1 for _ in iter_partition(file_path))
 
         # 3. Print some debug info
         print(f"Science articles in DBMS1: {dbms1_science_count}")
@@ -157,20 +204,27 @@ def upload_data_to_mongodb(input_dir):
             return False
 
         data_mappings = [
-            (dbms1, "User", f"{input_dir}/user_beijing.json"),
-            #(dbms1, "Article", f"{input_dir}/article_science.json"),
-            (dbms1, "Read", f"{input_dir}/read_beijing.json"),
-            (dbms2, "User", f"{input_dir}/user_hongkong.json"),
-            (dbms2, "Article", f"{input_dir}/article_technology.json"),
-            (dbms2, "Read", f"{input_dir}/read_hongkong.json")
+            (dbms1, "User", f"{input_dir}/user_beijing.ndjson"),
+            #(dbms1, "Article", f"{input_dir}/article_science.ndjson"),
+            (dbms1, "Read", f"{input_dir}/read_beijing.ndjson"),
+            (dbms2, "User", f"{input_dir}/user_hongkong.ndjson"),
+            (dbms2, "Article", f"{input_dir}/article_technology.ndjson"),
+            (dbms2, "Read", f"{input_dir}/read_hongkong.ndjson")
         ]
 
-        for db, collection, file_path in data_mappings:
-            if not insert_data_into_collection(db, collection, file_path):
-                return False
-            
-        # Now handle the science articles separately, distributing them randomly
-        if not distribute_science_articles(input_dir):
+        # Load every target concurrently, one worker per DBMS/collection.
+        # The science articles are handled separately, distributing them randomly
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=len(data_mappings) + 1) as executor:
+            futures = [
+                executor.submit(insert_data_into_collection, db, collection, file_path)
+                for db, collection, file_path in data_mappings
+            ]
+            futures.append(executor.submit(distribute_science_articles, input_dir))
+            results = [future.result() for future in futures]
+        print(f"Loaded all partitions in {time.time() - start:.2f} seconds.")
+
+        if not all(results):
             return False
         
         # Distribution Verification 
@@ -193,14 +247,51 @@ def is_directory_empty(directory_path):
     """Checks if a directory is empty."""
     return not os.path.exists(directory_path) or not os.listdir(directory_path)
 
+# Markers of the setup stages that loaded data, one document per stage in both databases
+SETUP_MARKERS = "Setup-Stages"
+
+def mark_loaded(stage, collection_names):
+    """
+    Record in both databases that a stage loaded its collections, under a new load id.
+    The app keeps writing to these collections, so their counts can't verify the load.
+    A marker can, and it is removed with the data when the databases are cleared.
+    """
+    load_id = uuid.uuid4().hex
+    for db in get_dbms_dbs():
+        db[SETUP_MARKERS].replace_one({"_id": stage}, {
+            "_id": stage,
+            "loadId": load_id,
+            "loadedAt": time.time(),
+            "counts": {name: db[name].estimated_document_count() for name in collection_names},
+        }, upsert=True)
+    return True
+
+def loaded_markers(stage):
+    """Load id of a stage in both databases (None where it didn't load), as recorded in the stage manifests."""
+    return {db.name: (db[SETUP_MARKERS].find_one({"_id": stage}) or {}).get("loadId") for db in get_dbms_dbs()}
+
+def clear_collection(collection_name):
+    """Removes every document of a collection in both databases."""
+    for db in get_dbms_dbs():
+        db[collection_name].delete_many({})
+
 def setup_databases(
     should_compose=True, 
     input_dir='data/raw', 
     data_output_dir='data/database/articles', 
     data_partitioned_dir='data/database/partitioned', 
-    dat_files_output_dir='data/database/dat_files'
+    dat_files_output_dir='data/database/dat_files',
+    generation_workers=1,
+    generation_seed=None,
+    media_mode="copy",
+    manifest_dir=MANIFEST_DIR,
+    be_read_workers=1
 ):
-    """Sets up databases by orchestrating Docker, data generation, partitioning, and MongoDB upload."""
+    """
+    Sets up databases by orchestrating Docker, data generation, partitioning, and MongoDB upload.
+    Every stage is checkpointed with a manifest (see utils/stage_manifest.py) and
+    skipped when its inputs are unchanged and its outputs still verify.
+    """
     print("Setting up databases...")
 
     if should_compose:
@@ -211,53 +302,146 @@ def setup_databases(
             if not docker_compose_up():
                 return False
 
+    dat_files = [f"{dat_files_output_dir}/{name}.dat" for name in ("user", "article", "read")]
+    generation_params = {
+        "num_users": 10000,
+        "num_articles": 10000,
+        "num_reads": 1000000,
+        "gb_size": 10,
+        "workers": generation_workers,
+        "seed": generation_seed,
+        "media_mode": media_mode,
+    }
+
+    # Generate
     ensure_directory_exists(data_output_dir)
-    if is_directory_empty(data_output_dir):
-        print("Generating data...")
-        if not generate_data(
-            num_users=10000, 
-            num_articles=10000,
-            num_reads=1000000, 
+    print("Generating data...")
+    if not run_stage(
+        "generate",
+        inputs={"params": generation_params, "raw": fingerprint_tree(input_dir)},
+        run=lambda: generate_data(
             input_dir=input_dir, 
             data_output_dir=data_output_dir, 
             dat_files_output_dir=dat_files_output_dir, 
-            gb_size=10
-        ):
-            print("Data generation failed.")
-            return False
-        print("Data generation completed.")
+            **generation_params
+        ),
+        count_outputs=lambda: {"dat_files": fingerprint_files(dat_files), "articles": count_entries(data_output_dir)},
+        manifest_dir=manifest_dir,
+        # Data generated before there were manifests
+        adopt=lambda: not is_directory_empty(data_output_dir) and all(os.path.exists(path) for path in dat_files),
+    ):
+        print("Data generation failed.")
+        return False
 
+    # Partition
+    partition_files = [
+        f"{data_partitioned_dir}/{file_name}"
+        for partitions in (USER_PARTITIONS, ARTICLE_PARTITIONS, READ_PARTITIONS)
+        for file_name in partitions.values()
+    ]
     ensure_directory_exists(data_partitioned_dir)
-    if is_directory_empty(data_partitioned_dir):
-        print("Partitioning data...")
-        if not partition_all(
+    print("Partitioning data...")
+    if not run_stage(
+        "partition",
+        inputs={"generate": manifest_digest("generate", manifest_dir)},
+        run=lambda: partition_all(
             input_dir=dat_files_output_dir, 
             output_dir=data_partitioned_dir
-        ):
-            print("Data partitioning failed.")
-            return False
-        print("Data partitioning completed.")
+        ),
+        count_outputs=lambda: fingerprint_files(partition_files),
+        manifest_dir=manifest_dir,
+        adopt=lambda: all(os.path.exists(path) for path in partition_files),
+    ):
+        print("Data partitioning failed.")
+        return False
+
+    # Upload (this clears every collection, so everything after it depends on its digest)
+    def load_data():
+        # The indexes are built after the bulk load instead of being maintained during it
+        drop_indexes(get_dbms_dbs())
+        return upload_data_to_mongodb(data_partitioned_dir) and mark_loaded("upload", ["User", "Article", "Read"])
 
     print("Uploading data to MongoDB...")
-    if not upload_data_to_mongodb(data_partitioned_dir):
+    if not run_stage(
+        "upload",
+        inputs={"partition": manifest_digest("partition", manifest_dir)},
+        run=load_data,
+        count_outputs=lambda: loaded_markers("upload"),
+        manifest_dir=manifest_dir,
+    ):
         print("Data upload to MongoDB failed.")
         return False
-    
-    # Populate Be-Read table
+
+    # Indexes of the catalog in utils/indexes.py
+    print("Creating indexes...")
+    if not run_stage(
+        "indexes",
+        inputs={"catalog": catalog_spec(), "upload": manifest_digest("upload", manifest_dir)},
+        run=lambda: apply_indexes(get_dbms_dbs()),
+        count_outputs=lambda: list_indexes(get_dbms_dbs()),
+        manifest_dir=manifest_dir,
+    ):
+        print("Index creation failed.")
+        return False
+
+    # Populate Be-Read table (and the per day rollups next to it)
+    def build_be_read():
+        clear_collection("Be-Read")
+        clear_collection(ROLLUP_COLLECTION)
+        if populate_be_read_table(dat_files_output_dir, be_read_workers) is None:
+            return False
+        return mark_loaded("be_read", ["Be-Read", ROLLUP_COLLECTION])
+
     print("Populating Be-Read table...")
-    be_read_data = populate_be_read_table(dat_files_output_dir)
+    if not run_stage(
+        "be_read",
+        inputs={
+            "generate": manifest_digest("generate", manifest_dir),
+            "upload": manifest_digest("upload", manifest_dir),
+        },
+        run=build_be_read,
+        count_outputs=lambda: loaded_markers("be_read"),
+        manifest_dir=manifest_dir,
+    ):
+        print("Be-Read population failed.")
+        return False
     print("Be-Read table populated.")
-    
-    # Populate Popular-Rank table
+
+    # Populate Popular-Rank table (ranked from the per day rollups)
+    def build_popular_rank():
+        clear_collection("Popular-Rank")
+        clear_collection(POPULAR_RANK_LATEST)
+        populate_popular_rank()
+        return mark_loaded("popular_rank", ["Popular-Rank", POPULAR_RANK_LATEST])
+
     print("Populating Popular-Rank table...")
-    populate_popular_rank(be_read_data)
+    if not run_stage(
+        "popular_rank",
+        inputs={"be_read": manifest_digest("be_read", manifest_dir)},
+        run=build_popular_rank,
+        count_outputs=lambda: loaded_markers("popular_rank"),
+        manifest_dir=manifest_dir,
+    ):
+        print("Popular-Rank population failed.")
+        return False
     print("Popular-Rank table populated.")
 
     # Upload unstructured media (bulk media upload)
+    def upload_media():
+        bulk_upload_articles()  # Call the bulk upload function
+        return True
+
     print("Uploading media files to GridFS...")
     start_bulk = time.time()
     try:
-        bulk_upload_articles()  # Call the bulk upload function
+        if not run_stage(
+            "media",
+            inputs={"generate": manifest_digest("generate", manifest_dir)},
+            run=upload_media,
+            count_outputs=lambda: {"files": count_media_files()},
+            manifest_dir=manifest_dir,
+        ):
+            return False
         print("Media files uploaded successfully.")
     except Exception as e:
         print(f"Error during media upload: {e}")
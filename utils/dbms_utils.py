@@ -1,23 +1,29 @@
-import os
-import re
+import sys
+import heapq
+from itertools import islice
 import json
 import random
-from pymongo import MongoClient
-from pymongo.errors import ConnectionFailure
+from pymongo import UpdateOne
+from utils.connections import get_client
 from utils.read_media import read_file_into_variable
+from utils.user_directory import user_directory
+from utils.result_cache import result_cache
+from utils.query_router import route, shard_map, placement_fields, ALL_SHARDS
+from utils.scatter_gather import scatter_gather, scatter_gather_all, ShardError, SHARD_TIMEOUT
+from utils.streaming_find import ShardedFind, MergeKey, PAGE_SIZE, parse_sort, parse_projection, fetch_projection
+from utils.indexes import explain_find
+from utils.be_read import aggregate_read_documents, be_read_delta, rollup_deltas, ROLLUP_COLLECTION
+from utils.popularity import top_articles_in_window
+from utils.popular_rank import latest_popular_rank, popular_rank_scheduler, rollup_changes
+from utils.query_parser import parse_query, parse_argument, QueryParseError
+from utils.distributed_join import distributed_join, colocated_distinct, JOIN_BATCH_SIZE
+from utils.distributed_aggregate import distributed_aggregate
 
 def get_clients():
-    """Connect to MongoDB for both databases (DBMS1 and DBMS2)."""
-    try:
-        dbms1_port = int(os.getenv("DBMS1_PORT", 27017))
-        dbms2_port = int(os.getenv("DBMS2_PORT", 27018))
-
-        client1 = MongoClient("localhost", dbms1_port)  # DBMS1 (Beijing)
-        client2 = MongoClient("localhost", dbms2_port)  # DBMS2 (Hong Kong)
-        return client1, client2
-    except ConnectionFailure as e:
-        print(f"Error connecting to MongoDB: {e}")
-        exit(1)
+    """The shared MongoDB clients of both databases (DBMS1 and DBMS2)."""
+    client1 = get_client("DBMS1")  # DBMS1 (Beijing)
+    client2 = get_client("DBMS2")  # DBMS2 (Hong Kong)
+    return client1, client2
 
 def get_dbms_dbs():
     """Retrieve database objects for DBMS1 and DBMS2."""
@@ -32,6 +38,7 @@ def clear_database(db):
         for collection_name in db.list_collection_names():
             db[collection_name].delete_many({})
             print(f"Cleared collection: {collection_name} in database {db.name}")
+        result_cache.invalidate()
         return True
     except Exception as e:
         print(f"Error clearing database {db.name}: {e}")
@@ -44,28 +51,30 @@ def clear_all_data():
 
 def split_query(query):
     """
-    Split a query into command, collection, and JSON arguments.
-    Handles spaces inside JSON structures.
+    Split a query into command, words and JSON arguments (parsed values).
+    JSON arguments may contain spaces, nested documents and Mongo operators.
 
     Ex.
     find Article {"id": "a1"}                           Gets split into 3 pieces
     delete Article {"id": "a1"}                         Gets split into 3 pieces
     update Article {"id": "a1"} {"title": "New Title"}  Gets split into 4 pieces
     """
+    plan = parse_query(query)
+    return [plan.command, *plan.words, *plan.arguments]
 
-    # We get the query prefix (command and collection)
-    query_prefix = query.split(" ")[:2]
-
-    # We get the arguments in json structure
-    regex = "[^{]+({[^}]+})+"
-    query_arguments = re.findall(regex, query)
-    # print(query_arguments)
-
-    combined_query = query_prefix + query_arguments
-
-    print(combined_query)
-
-    return combined_query
+def find_on_shards(dbms1_db, dbms2_db, collection_name, filter_query, targets=ALL_SHARDS, timeout=SHARD_TIMEOUT):
+    """
+    Run a find on several shards concurrently and return the combined documents (in shard order).
+    Each shard gets timeout seconds, also enforced on the server through maxTimeMS.
+    """
+    shards = shard_map(dbms1_db, dbms2_db)
+    max_time_ms = int(timeout * 1000)
+    tasks = {
+        shard: (lambda db=shards[shard]: list(db[collection_name].find(filter_query).max_time_ms(max_time_ms)))
+        for shard in targets
+    }
+    results = scatter_gather(tasks, timeout)
+    return [doc for shard in targets for doc in results.get(shard, [])]
 
 def print_results(collection_name, result):
     """
@@ -113,8 +122,50 @@ def print_results(collection_name, result):
     print("=" * header_line_len)
     print("")  # extra spacing
 
+def print_results_paged(collection_name, documents, page_size=PAGE_SIZE, interactive=None):
+    """
+    Print an iterable of documents one page at a time, so results are never held
+    in memory as a whole. When interactive (a terminal by default) the user is
+    asked before every next page. Returns True if all documents were printed.
+    """
+    if interactive is None:
+        interactive = sys.stdin.isatty()
+
+    page = []
+    page_number = 0
+    for document in documents:
+        page.append(document)
+        if len(page) < page_size:
+            continue
+
+        page_number += 1
+        print_results(f"{collection_name} (page {page_number})", page)
+        page = []
+        if interactive and input("Enter for the next page, q to stop: ").strip().lower() == "q":
+            return False
+
+    if page or page_number == 0:
+        print_results(collection_name if page_number == 0 else f"{collection_name} (page {page_number + 1})", page)
+    return True
+
 def get_user_by_id(user_id):
-    return {"Region": "Beijing"}
+    """The uid and region of a user (through the user directory), or None if it doesn't exist."""
+    dbms1_db, dbms2_db = get_dbms_dbs()
+    region = user_directory.lookup(dbms1_db, dbms2_db, user_id)
+    if region is None:
+        return None
+    return {"uid": user_id, "region": region}
+
+def pin_user_filter(collection, filter_query):
+    """
+    Resolve a User filter to the single document update_one/delete_one would
+    touch, so its uid can be dropped from the user directory afterwards.
+    Returns the filter to use and the affected uids.
+    """
+    user = collection.find_one(filter_query, {"uid": 1})
+    if user is None:
+        return filter_query, []
+    return {"_id": user["_id"]}, [user.get("uid")]
 
 def distribute_article(dbms1_data, dbms2_data):
     # From the setup we have science/technology = 45%/55%
@@ -134,6 +185,11 @@ def split_data_by_database(collection_name, data):
     dbms1_data = []
     dbms2_data = []
 
+    # Reads are routed by their user's region, looked up for the whole batch at once
+    if collection_name == "Read":
+        dbms1_db, dbms2_db = get_dbms_dbs()
+        uid_regions = user_directory.lookup_many(dbms1_db, dbms2_db, [document["uid"] for document in data])
+
     for document in data:
         # Partition users by region
         if collection_name == "User":
@@ -147,8 +203,7 @@ def split_data_by_database(collection_name, data):
         # Partition reads based on users region
         elif collection_name == "Read":
             user_id = document["uid"]
-            user = get_user_by_id(user_id)
-            user_region = user["region"]
+            user_region = uid_regions.get(user_id)
             if user_region == "Beijing":
                 dbms1_data.append(document)
             elif user_region == "Hong Kong":
@@ -168,11 +223,11 @@ def split_data_by_database(collection_name, data):
         elif collection_name == "Be-Read":
             dbms1_db, dbms2_db = get_dbms_dbs()
             aid = document["aid"]
-            filter = eval('{"aid": ' + f'"{aid}"' + '}')
+            filter = {"aid": aid}
             dbms1_result = list(dbms1_db["Article"].find(filter))
             dbms2_result = list(dbms2_db["Article"].find(filter))
             combined_result = dbms1_result + dbms2_result
-            matching_document = combined_result[0]
+            matching_document = combined_result[0] if combined_result else None
 
             if matching_document:
                 if matching_document["category"] == "science":
@@ -220,6 +275,24 @@ def handle_insert(dbms1_db, dbms2_db, collection_name, entries, should_print=Tru
             if should_print:
                 print(f"Inserted {len(dbms2_data)} documents into DBMS2, collection '{collection_name}'.")
 
+        # New users can be routed to right away
+        if collection_name == "User":
+            for user in dbms1_data + dbms2_data:
+                if "uid" in user:
+                    user_directory.put(user["uid"], user["region"])
+
+        # Cached results computed from this collection are outdated
+        result_cache.invalidate([collection_name])
+
+        # New reads are counted in Be-Read right away
+        if collection_name == "Read":
+            try:
+                update_be_read(dbms1_db, dbms2_db, dbms1_data + dbms2_data, should_print)
+            except ShardError as e:
+                # The $inc deltas can't safely be retried, a shard may already have applied them
+                print(f"Error updating Be-Read, the inserted reads may not be counted in it: {e}")
+                return False
+
         return True
     except json.JSONDecodeError as e:
         print(f"Error parsing JSON: {e}")
@@ -228,55 +301,314 @@ def handle_insert(dbms1_db, dbms2_db, collection_name, entries, should_print=Tru
         print(f"Error during insert: {e}")
         return False
 
-def handle_find(dbms1_db, dbms2_db, collection_name, filter):
-    """Find documents in a collection."""
+def update_be_read(dbms1_db, dbms2_db, reads, should_print=True):
+    """
+    Count inserted reads in Be-Read without recomputing it. The reads are turned into
+    one delta per aid ($inc the counters, $addToSet the uids, $max the timestamp) that
+    is upserted, in one unordered bulk write per DBMS, where the aid's row is. Rows of
+    new aids go where the setup puts them: technology on DBMS2, science spread 80/20.
+    The aid's per day rollups are incremented on the same DBMS.
+    Returns the number of Be-Read rows updated or created. Raises ShardError if a
+    DBMS fails or times out, as the rows would be misplaced or not counted.
+    """
+    states = aggregate_read_documents(reads)
+    if not states:
+        return 0
+    aids = list(states)
+    shards = shard_map(dbms1_db, dbms2_db)
+
+    # Shard of every existing row (a missing answer would make existing rows look new)
+    max_time_ms = int(SHARD_TIMEOUT * 1000)
+    rows = scatter_gather_all({
+        shard: (lambda db=shards[shard]: [
+            row["aid"] for row in db["Be-Read"].find({"aid": {"$in": aids}}, {"aid": 1}).max_time_ms(max_time_ms)
+        ])
+        for shard in ALL_SHARDS
+    })
+    placement = {}
+    for shard in ALL_SHARDS:
+        for aid in rows.get(shard, []):
+            placement.setdefault(aid, shard)
+
+    # Place the rows of aids that weren't read before by their article's category
+    new_aids = [aid for aid in aids if aid not in placement]
+    if new_aids:
+        article_filter = {"aid": {"$in": new_aids}}
+        articles = scatter_gather_all({
+            shard: (lambda db=shards[shard]: list(db["Article"].find(article_filter, {"aid": 1, "category": 1}).max_time_ms(max_time_ms)))
+            for shard in route(dbms1_db, dbms2_db, "Article", article_filter)
+        })
+        categories = {article["aid"]: article.get("category") for found in articles.values() for article in found}
+        for aid in new_aids:
+            if categories.get(aid) == "technology":
+                placement[aid] = "DBMS2"
+            elif categories.get(aid) == "science":
+                placement[aid] = distribute_article("DBMS1", "DBMS2")
+            else:
+                print(f"There is no article with aid: {aid}, its reads are not counted in Be-Read.")
+
+    operations = {shard: [] for shard in ALL_SHARDS}
+    rollup_operations = {shard: [] for shard in ALL_SHARDS}
+    days = set()
+    for aid, state in states.items():
+        if aid in placement:
+            operations[placement[aid]].append(UpdateOne({"aid": aid}, be_read_delta(state), upsert=True))
+            for day_filter, update in rollup_deltas(aid, state):
+                rollup_operations[placement[aid]].append(UpdateOne(day_filter, update, upsert=True))
+                days.add(day_filter["day"])
+
+    def write(db, ops, rollup_ops):
+        db["Be-Read"].bulk_write(ops, ordered=False)
+        db[ROLLUP_COLLECTION].bulk_write(rollup_ops, ordered=False)
+
+    try:
+        scatter_gather_all({
+            shard: (lambda db=shards[shard], ops=ops, rollup_ops=rollup_operations[shard]: write(db, ops, rollup_ops))
+            for shard, ops in operations.items() if ops
+        })
+    finally:
+        # Some shards may have been written before another one failed
+        result_cache.invalidate(["Be-Read", ROLLUP_COLLECTION])
+        # The rankings of windows with these days are recomputed at the next refresh
+        rollup_changes.mark(days)
+
+    updated = sum(len(ops) for ops in operations.values())
+    if should_print:
+        print(f"Updated {updated} Be-Read rows.")
+    return updated
+
+def handle_find(dbms1_db, dbms2_db, collection_name, filter, explain=False, options=None):
+    """
+    Find documents in a collection, only asking the shards that can hold matches.
+    Results are streamed to the console page by page.
+
+    options (dict or JSON string) may contain:
+        projection  "uid,aid" or a projection document
+        sort        "-timestamp,uid" or {"timestamp": -1}
+        limit, skip
+        cursor      token printed after a page, to continue from there
+        page_size
+    """
     if collection_name == None or filter == None:
         print("Error: Find command requires a collection name and a filter.")
         return
-    filter_query = eval(filter)
-    dbms1_result = list(dbms1_db[collection_name].find(filter_query))
-    dbms2_result = list(dbms2_db[collection_name].find(filter_query))
-    combined_result = dbms1_result + dbms2_result
-    print_results(collection_name, combined_result)
-
-def handle_update(dbms1_db, dbms2_db, collection_name, filter_str, update_str):
+    filter_query = parse_argument(filter, {})
+    options = parse_argument(options, {})
+
+    targets = route(dbms1_db, dbms2_db, collection_name, filter_query, explain, "find")
+    page_size = int(options.get("page_size", PAGE_SIZE))
+    results = ShardedFind(
+        shard_map(dbms1_db, dbms2_db),
+        targets,
+        collection_name,
+        filter_query,
+        projection=options.get("projection"),
+        sort=options.get("sort"),
+        limit=options.get("limit"),
+        skip=options.get("skip", 0),
+        cursor=options.get("cursor"),
+        batch_size=page_size,
+    )
+    print_results_paged(collection_name, results, page_size)
+
+    next_cursor = results.next_cursor()
+    if next_cursor:
+        print(f'More results available, continue with {{"cursor": "{next_cursor}"}}')
+
+def handle_update(dbms1_db, dbms2_db, collection_name, filter_str, update_str, explain=False):
     if collection_name == None or filter_str == None or update_str == None:
         print("Error: Update command requires a collection name, a filter, and an update.")
         return
     
-    filter_query = eval(filter_str)
-    update_query = eval(update_str)
+    filter_query = parse_argument(filter_str, {})
+    update_query = parse_argument(update_str, {})
+
+    # The document would stay on its shard while routing looks for it on another one
+    changed_placement = sorted({field.split(".")[0] for field in update_query} & placement_fields(collection_name))
+    if changed_placement:
+        print(f"Error: '{collection_name}' documents can't change {', '.join(changed_placement)} "
+              f"in place, the DBMS of documents is routed by it. Delete and insert the document instead.")
+        return
 
     # Wrap the update query with $set
     update_query = {"$set": update_query}
             
-    # Attempt to update in DBMS1
-    dbms1_result = dbms1_db[collection_name].update_one(filter_query, update_query)
-    if dbms1_result.modified_count > 0:
-        print(f"Modified {dbms1_result.modified_count} document(s) in DBMS1 collection '{collection_name}'.")
-    else:
-        # If no documents were updated in DBMS1, try updating in DBMS2
-        dbms2_result = dbms2_db[collection_name].update_one(filter_query, update_query)
-        if dbms2_result.modified_count > 0:
-            print(f"Modified {dbms2_result.modified_count} document(s) in DBMS2 collection '{collection_name}'.")
-        else:
-            print("No matching documents found in either DBMS1 or DBMS2.")
+    # Attempt to update in the shards that can hold the document, DBMS1 first
+    shards = shard_map(dbms1_db, dbms2_db)
+    for name in route(dbms1_db, dbms2_db, collection_name, filter_query, explain, "update"):
+        db = shards[name]
+        target_filter, uids = filter_query, []
+        if collection_name == "User":
+            target_filter, uids = pin_user_filter(db[collection_name], filter_query)
 
-def handle_delete(dbms1_db, dbms2_db, collection_name, filter_str):
+        result = db[collection_name].update_one(target_filter, update_query)
+        if result.modified_count > 0:
+            user_directory.invalidate(uids)
+            result_cache.invalidate([collection_name])
+            print(f"Modified {result.modified_count} document(s) in {name} collection '{collection_name}'.")
+            return
+
+    print("No matching documents found in either DBMS1 or DBMS2.")
+
+def handle_delete(dbms1_db, dbms2_db, collection_name, filter_str, explain=False):
     if collection_name == None or filter_str == None:
         print("Error: Delete command requires a collection name and a filter.")
         return
-    filter_query = eval(filter_str)
-    dbms1_result = dbms1_db[collection_name].delete_one(filter_query)
-    if dbms1_result.deleted_count > 0:
-        print(f"Deleted {dbms1_result.deleted_count} document(s) in DBMS1 collection '{collection_name}'.")
+    filter_query = parse_argument(filter_str, {})
+
+    # Attempt to delete in the shards that can hold the document, DBMS1 first
+    shards = shard_map(dbms1_db, dbms2_db)
+    for name in route(dbms1_db, dbms2_db, collection_name, filter_query, explain, "delete"):
+        db = shards[name]
+        target_filter, uids = filter_query, []
+        if collection_name == "User":
+            target_filter, uids = pin_user_filter(db[collection_name], filter_query)
+
+        result = db[collection_name].delete_one(target_filter)
+        if result.deleted_count > 0:
+            user_directory.invalidate(uids)
+            result_cache.invalidate([collection_name])
+            print(f"Deleted {result.deleted_count} document(s) in {name} collection '{collection_name}'.")
+            return
+
+    print("No matching documents found in either DBMS1 or DBMS2.")
+
+# --------------- Top-k ---------------
+
+def find_top(dbms1_db, dbms2_db, collection_name, field, n, filter_query=None,
+             descending=True, early_stop=False, projection=None, explain=False):
+    """
+    The top n documents of a collection by field, across the shards.
+
+    Every shard only returns its own top n (sort + limit pushed down), which are
+    heap merged here, so at most n documents per shard are transferred.
+    With early_stop the shards are asked one after the other: once n documents
+    are known, the n-th value becomes a threshold the remaining shards filter on,
+    so they only send documents that can still make it into the top n.
+    """
+    filter_query = filter_query or {}
+    n = int(n)
+    direction = -1 if descending else 1
+    sort_spec = [(field, direction), ("_id", 1)]
+    shards = shard_map(dbms1_db, dbms2_db)
+    targets = route(dbms1_db, dbms2_db, collection_name, filter_query, explain, "top")
+    # The merge and the early stop threshold need the sort fields, even if the projection leaves them out
+    projection, extra_fields = fetch_projection(projection, sort_spec)
+
+    def shard_top(db, shard_filter):
+        return list(db[collection_name].find(shard_filter, projection).sort(sort_spec).limit(n))
+
+    if not early_stop or len(targets) < 2:
+        results = scatter_gather({shard: (lambda db=shards[shard]: shard_top(db, filter_query)) for shard in targets})
+        partials = [results[shard] for shard in targets if shard in results]
     else:
-        # If no documents were deleted in DBMS1, try deleting in DBMS2
-        dbms2_result = dbms2_db[collection_name].delete_one(filter_query)
-        if dbms2_result.deleted_count > 0:
-            print(f"Deleted {dbms2_result.deleted_count} document(s) in DBMS2 collection '{collection_name}'.")
-        else:
-            print("No matching documents found in either DBMS1 or DBMS2.")
+        partials = []
+        for shard in targets:
+            shard_filter = filter_query
+            known = list(islice(heapq.merge(*partials, key=lambda doc: MergeKey(doc, sort_spec)), n))
+            if len(known) == n and field in known[-1]:
+                threshold = {("$gte" if descending else "$lte"): known[-1][field]}
+                shard_filter = {"$and": [filter_query, {field: threshold}]}
+                if explain:
+                    print(f"Explain: {shard} only returns {field} {threshold}")
+            partials.append(shard_top(shards[shard], shard_filter))
+
+    top = list(islice(heapq.merge(*partials, key=lambda doc: MergeKey(doc, sort_spec)), n))
+    for document in top:
+        for extra_field in extra_fields:
+            document.pop(extra_field, None)
+    return top
+
+def handle_top(dbms1_db, dbms2_db, collection_name, field, n, filter_str=None, options=None):
+    """
+    top <collection> <field> <n> [filter] [options]
+    options: {"order": "asc"|"desc", "early_stop": true, "projection": "aid,readNum", "explain": true}
+    """
+    if collection_name is None or field is None or n is None:
+        print("Error: Top command requires a collection name, a field and a number of documents.")
+        return []
+    filter_query = parse_argument(filter_str, {})
+    options = parse_argument(options, {})
+
+    projection = options.get("projection")
+    if isinstance(projection, str):
+        projection = {name.strip(): 1 for name in projection.split(",") if name.strip()}
+
+    top = find_top(
+        dbms1_db, dbms2_db, collection_name, field, n, filter_query,
+        descending=str(options.get("order", "desc")).lower() != "asc",
+        early_stop=bool(options.get("early_stop", False)),
+        projection=projection,
+        explain=bool(options.get("explain", False)),
+    )
+    print_results(f"Top {n} of '{collection_name}' by {field}", top)
+    return top
+
+# --------------- Aggregation ---------------
+
+def handle_aggregate(dbms1_db, dbms2_db, collection_name, group_by, metrics, filter_str=None, options=None):
+    """
+    aggregate <collection> <group_by> <metrics> [filter] [options]
+    group_by: comma separated fields, "_shard" for the DBMS holding the document, "-" for one group
+    metrics:  comma separated count, sum:<field>, avg:<field>, min:<field>, max:<field>, distinct:<field> (approximate)
+    options:  {"sort": "-count", "limit": 10, "explain": true}
+    """
+    if collection_name is None or group_by is None:
+        print("Error: Aggregate command requires a collection name and the fields to group by.")
+        return []
+    filter_query = parse_argument(filter_str, {})
+    options = parse_argument(options, {})
+
+    rows = distributed_aggregate(
+        dbms1_db, dbms2_db, collection_name, group_by, metrics or "count", filter_query,
+        sort=options.get("sort"),
+        limit=options.get("limit"),
+        explain=bool(options.get("explain", False)),
+    )
+    print_results_paged(f"Aggregate of '{collection_name}' by {group_by}", rows, int(options.get("page_size", PAGE_SIZE)))
+    return rows
+
+# --------------- Explain ---------------
+
+def handle_explain(dbms1_db, dbms2_db, query):
+    """
+    explain <find|top|update|delete query>
+    Prints the shards the query is routed to and, per shard, the winning plan and
+    how many index keys and documents it examined. Update and delete are explained
+    as the single document find they do to locate their target.
+    """
+    plan = parse_query(query)
+    collection_name = plan.collection
+    if collection_name is None:
+        print("Error: Explain requires a query, e.g. explain find Read {\"uid\": \"1\"}")
+        return []
+    filter_query = parse_argument(plan.argument(0), {})
+    options = parse_argument(plan.argument(1), {})
+
+    if plan.command == "find":
+        sort = parse_sort(options.get("sort"))
+        limit = options.get("limit")
+        projection = parse_projection(options.get("projection"))
+    elif plan.command == "top":
+        direction = 1 if str(options.get("order", "desc")).lower() == "asc" else -1
+        sort = [(plan.word(1), direction), ("_id", 1)]
+        limit = plan.word(2)
+        projection = parse_projection(options.get("projection"))
+    elif plan.command in ("update", "delete"):
+        sort, limit, projection = None, 1, None
+    else:
+        print(f"Error: explain supports find, top, update and delete, not '{plan.command}'.")
+        return []
+
+    shards = shard_map(dbms1_db, dbms2_db)
+    targets = route(dbms1_db, dbms2_db, collection_name, filter_query, True, plan.command)
+    results = scatter_gather({
+        shard: (lambda db=shards[shard]: explain_find(db, collection_name, filter_query, sort, limit, projection))
+        for shard in targets
+    })
+    rows = [{"shard": shard, **results[shard]} for shard in targets if shard in results]
+    print_results(f"Explain of {plan.command} on '{collection_name}'", rows)
+    return rows
 
 """
 Non-implemented Handle Join
@@ -342,126 +674,102 @@ def handle_join(dbms1_db, dbms2_db, collection1_name, collection2_name, join_con
 def handle_query(dbms1_db, dbms2_db, query):
     """Process user query and interact with databases."""
     try:
-        # If user is asking for status, we don't need any splitting
-        if query.lower() == "status":
+        # Parse the query into a plan: command, bare words and JSON arguments
+        plan = parse_query(query)
+        command = plan.command
+        collection_name = plan.collection
+
+        # If user is asking for status, we don't need any arguments
+        if command == "status":
             print("DBMS1 Collections:", dbms1_db.list_collection_names())
             print("DBMS2 Collections:", dbms2_db.list_collection_names())
+            print("Result cache:", result_cache.stats())
+            print("Popular-Rank refresh:", popular_rank_scheduler.stats())
 
-        elif query.split(" ")[0].lower() == "join":
-            # Expected usage (variable number of arguments):
-            # join <collection1> <collection2> <match_key> [filter1_json] [filter2_json] [projection1_json] [projection2_json] [final_projection_json]
-
-            query_parts = query.split(" ")
+        # Explain the query that follows
+        elif command == "explain":
+            return handle_explain(dbms1_db, dbms2_db, query.strip()[len("explain"):])
 
-            if len(query_parts) < 5:
-                print("Error: 'join' requires 5 parts: join <col1> <col2> <match_key> <filter1> <filter2>")
+        elif command == "join":
+            # Expected usage (variable number of arguments):
+            # join <collection1> <collection2> <match_key> [filter1_json] [filter2_json] [options_json]
+            if len(plan.words) < 3:
+                print("Error: 'join' requires: join <col1> <col2> <match_key> [filter1] [filter2] [options]")
                 return
 
-            collection1 = query_parts[1]
-            collection2 = query_parts[2]
-            match_key   = query_parts[3]
-            filter1_str = query_parts[4]
-            filter2_str = query_parts[5] if len(query_parts) > 5 else None
-
-            # If user didn't provide filter2, assume '{}'
-            if not filter2_str:
-                filter2_str = "{}"
-
-            # parse filters (user can type {} or {"someKey":"someVal"})
-            def parse_filter(json_str):
-                try:
-                    return eval(json_str)
-                except Exception as e:
-                    print(f"Error parsing filter: {json_str}: {e}")
-                    return {}
-
-            filter1 = parse_filter(filter1_str)
-            filter2 = parse_filter(filter2_str)
-
+            # If user didn't provide the filters, assume {}
             join_collections(
                 dbms1_db=dbms1_db,
                 dbms2_db=dbms2_db,
-                collection1=collection1,
-                collection2=collection2,
-                match_key=match_key,
-                filter1=filter1,
-                filter2=filter2
+                collection1=plan.words[0],
+                collection2=plan.words[1],
+                match_key=plan.words[2],
+                filter1=plan.argument(0, {}),
+                filter2=plan.argument(1, {}),
+                options=plan.argument(2)
             )
 
-        else:
-            # Split the query into command and arguments
-            query_parts = split_query(query)  # Split into up to 3+ parts: command, collection, arguments & (optionally) data
-            command = query_parts[0].lower()
+        # Find documents matching filter in any of the Databases
+        elif command == "find":
+            handle_find(dbms1_db, dbms2_db, collection_name, plan.argument(0), options=plan.argument(1))
 
-            collection_name = query_parts[1]
+        # Update first document matching filter in any of the Databases
+        elif command == "update":
+            handle_update(dbms1_db, dbms2_db, collection_name, plan.argument(0), plan.argument(1))
 
-            
-            # Find documents matching filter in any of the Databases
-            if command == "find":
-                handle_find(dbms1_db, dbms2_db, collection_name, query_parts[2])
-
-            # Update first document matching filter in any of the Databases
-            elif command == "update":
-                handle_update(dbms1_db, dbms2_db, query_parts[1], query_parts[2], query_parts[3])
-
-            elif command == "find_articles_read":
-                read_articles = join_user_article(dbms1_db, dbms2_db, eval(query_parts[1]))
-                print_results('Top Articles', read_articles)
-                #print(f"Results for articles that user {query_parts[1]} read: {read_articles}")
-
-            elif command == "find_top_articles":
-                top_articles = join_beread_article(dbms1_db, dbms2_db, query_parts[1])
-                top_articles_media = []
-
-                for article in top_articles:
-                    article_media = {'id': article['id']}
-                    # Retrieve text content
-                    if article.get("text"):
-                        article_media["text_content"] = read_file_into_variable(article["text"])
-                    
-                    # Retrieve image content
-                    if article.get("image"):
-                        image_filenames = article["image"].strip(',').split(',')  # Split multiple filenames
-                        article_media["image_content"] = [
-                            read_file_into_variable(image) for image in image_filenames
-                        ]
-                    
-                    # Retrieve video content
-                    if article.get("video"):
-                        article_media["video_content"] = read_file_into_variable(article["video"])
-                    
-                    top_articles_media.append(article_media)
-                print_results('Top Articles', top_articles)
-                #print(f"Results for top 5 articles {query_parts[1]}: {top_articles}")
-
-                return top_articles, top_articles_media
-
-            # Delete first document matching filter in any of the Databases
-            elif command == "delete":
-                handle_delete(dbms1_db, dbms2_db, collection_name, query_parts[2])
-
-            # Insert a document into a collection
-            elif command == "insert":
-                # TODO FILTER WHICH DBMS TO INSERT INTO
-                handle_insert(dbms1_db, dbms2_db, collection_name, query_parts[2])
-
-            elif command == "insert_multiple":
-                # TODO FILTER WHICH DBMS TO INSERT INTO
-                handle_insert(dbms1_db, dbms2_db, query_parts[1], query_parts[2], multiple=True)
+        elif command == "top":
+            # top <collection> <field> <n> [filter] [options]
+            if len(plan.words) < 3:
+                print("Error: 'top' requires: top <collection> <field> <n> [filter] [options]")
+                return
+            return handle_top(dbms1_db, dbms2_db, collection_name, plan.words[1], plan.words[2],
+                              plan.argument(0), plan.argument(1))
 
-            else:
-                print("Unknown command. Available commands: Status, Find, Update, Delete, Insert.")
+        elif command == "aggregate":
+            # aggregate <collection> <group_by> [metrics] [filter] [options]
+            if len(plan.words) < 2:
+                print("Error: 'aggregate' requires: aggregate <collection> <group_by> [metrics] [filter] [options]")
+                return
+            return handle_aggregate(dbms1_db, dbms2_db, collection_name, plan.words[1], plan.word(2),
+                                    plan.argument(0), plan.argument(1))
+
+        elif command == "find_articles_read":
+            read_articles = join_user_article(dbms1_db, dbms2_db, plan.argument(0, {}))
+            print_results('Top Articles', read_articles)
+
+        elif command == "find_top_articles":
+            # find_top_articles [daily|weekly|monthly|custom <start> <end>] [{"media": true}]
+            options = parse_argument(plan.argument(0), {})
+            top_articles, top_articles_media = find_top_articles(
+                dbms1_db, dbms2_db, plan.word(0, "daily"), start=plan.word(1), end=plan.word(2)
+            )
+            print_results('Top Articles', top_articles)
+
+            # Media content is only downloaded from GridFS when asked for
+            if options.get("media"):
+                top_articles_media = [load_article_media(media) for media in top_articles_media]
+            return top_articles, top_articles_media
 
-            """
-            elif command == "join":
-                # Parse the join query parts
-                collection2 = query_parts[2]
-                match_field = query_parts[3] if len(query_parts) > 3 else "id"
-                conditions = json.loads(query_parts[4]) if len(query_parts) > 4 else None
+        # Delete first document matching filter in any of the Databases
+        elif command == "delete":
+            handle_delete(dbms1_db, dbms2_db, collection_name, plan.argument(0))
 
-                handle_join(dbms1_db, dbms2_db, collection_name, collection2, match_field, conditions)
-            """
+        # Insert a document into a collection
+        elif command == "insert":
+            handle_insert(dbms1_db, dbms2_db, collection_name, plan.argument(0))
+
+        # Insert a list of documents (or several documents) into a collection
+        elif command == "insert_multiple":
+            entries = plan.argument(0)
+            if not isinstance(entries, list):
+                entries = list(plan.arguments)
+            handle_insert(dbms1_db, dbms2_db, collection_name, entries, multiple=True)
+
+        else:
+            print("Unknown command. Available commands: Status, Find, Top, Aggregate, Join, Explain, Update, Delete, Insert.")
 
+    except QueryParseError as e:
+        print(f"Error parsing query: {e}")
     except Exception as e:
         print(f"Error handling query: {e}")
 
@@ -470,53 +778,116 @@ def handle_query(dbms1_db, dbms2_db, query):
 ########## JOINS ##########
 
 def join_user_article(dbms1_db, dbms2_db, user_filter):
-    """Joins User and Article tables based on user's read activity."""
-    # Step 1: Fetch users matching the filter
-    users = list(dbms1_db['User'].find(user_filter)) + list(dbms2_db['User'].find(user_filter))
-    uids = [user['uid'] for user in users]
-    
-    if not uids:
-        print("No users found matching the criteria.")
-        return []
-    
-    # Step 2: Fetch reads by these users
-    reads = list(dbms1_db['Read'].find({"uid": {"$in": uids}})) + list(dbms2_db['Read'].find({"uid": {"$in": uids}}))
-    aids = [read['aid'] for read in reads]
+    """
+    Joins User and Article tables based on user's read activity.
+    Users and their reads are on the same DBMS, so User and Read are joined
+    inside every DBMS and only the distinct aids read are sent back.
+    """
+    shards = shard_map(dbms1_db, dbms2_db)
+
+    # Step 1: Distinct aids read by the matching users, per shard (concurrently)
+    targets = route(dbms1_db, dbms2_db, 'User', user_filter)
+    aids = sorted(colocated_distinct(shards, targets, 'User', 'Read', 'uid', user_filter, 'aid'))
     
     if not aids:
         print("No articles found read by the specified users.")
         return []
     
-    # Step 3: Fetch articles by their IDs
-    articles = list(dbms1_db['Article'].find({"aid": {"$in": aids}})) + list(dbms2_db['Article'].find({"aid": {"$in": aids}}))
+    # Step 2: Fetch articles by their IDs, in chunks that keep the $in small
+    articles = []
+    for start in range(0, len(aids), JOIN_BATCH_SIZE):
+        articles += find_on_shards(dbms1_db, dbms2_db, 'Article', {"aid": {"$in": aids[start:start + JOIN_BATCH_SIZE]}})
     
     return articles
 
 
 def join_beread_article(dbms1_db, dbms2_db, temporal_granularity="daily"):
     """Joins Be-Read and Article tables to get popular articles with details."""
-    # Step 1: Fetch popular articles based on temporal granularity
-    popular_rank = list(dbms1_db['Popular-Rank'].find({"temporalGranularity": temporal_granularity})) + \
-                   list(dbms2_db['Popular-Rank'].find({"temporalGranularity": temporal_granularity}))
+    # Step 1: Fetch the latest ranking of the temporal granularity (one lookup of its pointer)
+    popular_rank = latest_popular_rank(dbms1_db, dbms2_db, temporal_granularity)
     
     if not popular_rank:
         print(f"No popular articles found for {temporal_granularity} granularity.")
         return []
     
-    # Extract top article IDs
-    article_aid_list = popular_rank[0].get('articleAidList', [])  # Assume articleAidList is sorted
+    # Extract top article IDs, best first
+    article_aid_list = popular_rank.get('articleAidList', [])
     
     if not article_aid_list:
         print("No article IDs found in the popular rank.")
         return []
     
     # Step 2: Fetch article details by their IDs
-    articles = list(dbms1_db['Article'].find({"aid": {"$in": article_aid_list}})) + \
-               list(dbms2_db['Article'].find({"aid": {"$in": article_aid_list}}))
-    
+    return articles_in_rank_order(dbms1_db, dbms2_db, article_aid_list)
+
+def articles_in_rank_order(dbms1_db, dbms2_db, article_aid_list):
+    """The articles of a ranking, in the order of the ranking."""
+    articles = find_on_shards(dbms1_db, dbms2_db, 'Article', {"aid": {"$in": article_aid_list}})
+    rank = {aid: position for position, aid in enumerate(article_aid_list)}
+    articles.sort(key=lambda article: rank.get(article.get('aid'), len(rank)))
     return articles
 
 
+# Collections a top articles result is computed from
+TOP_ARTICLES_SOURCES = ("Popular-Rank", "Be-Read", "Article", ROLLUP_COLLECTION)
+
+def article_media_handles(article):
+    """The GridFS filenames of an article's text, images and video."""
+    media = {'id': article['id']}
+    if article.get("text"):
+        media["text"] = article["text"]
+    if article.get("image"):
+        media["image"] = article["image"].strip(',').split(',')  # Split multiple filenames
+    if article.get("video"):
+        media["video"] = article["video"]
+    return media
+
+def load_article_media(media):
+    """The content of the media behind article_media_handles, read from GridFS."""
+    article_media = {'id': media['id']}
+    # Retrieve text content
+    if media.get("text"):
+        article_media["text_content"] = read_file_into_variable(media["text"])
+    # Retrieve image content
+    if media.get("image"):
+        article_media["image_content"] = [read_file_into_variable(image) for image in media["image"]]
+    # Retrieve video content
+    if media.get("video"):
+        article_media["video_content"] = read_file_into_variable(media["video"])
+    return article_media
+
+def find_top_articles(dbms1_db, dbms2_db, temporal_granularity="daily", use_cache=True, start=None, end=None):
+    """
+    The popular articles of a granularity and their media handles, as (articles, media).
+    The "custom" granularity ranks the articles from day start to day end (inclusive,
+    "YYYY-MM-DD") from the per day rollups instead of reading Popular-Rank.
+    Results are cached per granularity (and window) until one of TOP_ARTICLES_SOURCES
+    is written through dbms_utils or the cache TTL passes. Don't modify the returned lists.
+    """
+    key = ("find_top_articles", temporal_granularity, start, end)
+    if use_cache:
+        cached = result_cache.get(key)
+        if cached is not None:
+            return cached
+    # A ranking published while this one is computed must not be hidden by caching this one
+    generation = result_cache.generation(TOP_ARTICLES_SOURCES)
+
+    if temporal_granularity == "custom":
+        if start is None or end is None:
+            print("Error: a custom window needs a start and an end day (YYYY-MM-DD).")
+            return [], []
+        ranked = top_articles_in_window(dbms1_db, dbms2_db, start, end)
+        if not ranked:
+            print(f"No articles were read between {start} and {end}.")
+        top_articles = articles_in_rank_order(dbms1_db, dbms2_db, [aid for aid, _ in ranked]) if ranked else []
+    else:
+        top_articles = join_beread_article(dbms1_db, dbms2_db, temporal_granularity)
+    result = (top_articles, [article_media_handles(article) for article in top_articles])
+    if use_cache:
+        result_cache.put(key, result, TOP_ARTICLES_SOURCES, generation=generation)
+    return result
+
+
 def join_collections(
     dbms1_db, 
     dbms2_db, 
@@ -524,12 +895,13 @@ def join_collections(
     collection2, 
     match_key, 
     filter1=None, 
-    filter2=None
+    filter2=None,
+    options=None
 ):
     """
     Joins two collections based on a match_key.
-    Pulls only filtered rows from each DB to reduce workload.
-    Prints the joined result in a table.
+    The join strategy (co-located $lookup, chunked semi-join or broadcast) is
+    picked by the join engine, and the joined rows are printed page by page.
 
     Args:
         dbms1_db, dbms2_db: MongoDB database objects (distributed DB).
@@ -538,64 +910,27 @@ def join_collections(
         match_key (str): The field name to match on.
         filter1 (dict, optional): Filter for the first collection.
         filter2 (dict, optional): Filter for the second collection.
+        options (dict, optional): {"strategy": "colocated"|"semi-join"|"broadcast", "explain": true, "page_size": 50}
 
     Returns:
-        list: A list of joined documents.
+        int: The number of joined documents.
     """
-    if filter1 is None:
-        filter1 = {}
-    if filter2 is None:
-        filter2 = {}
-
-    # 1. Fetch from COLLECTION1 in both DBMS
-    data1_db1 = list(dbms1_db[collection1].find(filter1))
-    data1_db2 = list(dbms2_db[collection1].find(filter1))
-    data1 = data1_db1 + data1_db2
-
-    if not data1:
-        print(f"No documents found in '{collection1}' matching {filter1}.")
-        return []
-
-    # 2. Collect match_key values
-    match_values = [doc.get(match_key) for doc in data1 if match_key in doc]
-    match_values = list(set(match_values))  # avoid duplicates for the $in query
-    if not match_values:
-        print(f"No documents in '{collection1}' had the key '{match_key}'.")
-        return []
-
-    # 3. Build filter for COLLECTION2 to match on those values
-    filter2_with_match = {**filter2, match_key: {"$in": match_values}}
-
-    data2_db1 = list(dbms1_db[collection2].find(filter2_with_match))
-    data2_db2 = list(dbms2_db[collection2].find(filter2_with_match))
-    data2 = data2_db1 + data2_db2
-
-    if not data2:
-        print(f"No documents found in '{collection2}' matching {filter2_with_match}.")
-        return []
-
-    # 4. Build a dictionary for data2 keyed by match_key for faster lookups
-    data2_dict = {}
-    for doc2 in data2:
-        key_val = doc2.get(match_key)
-        if key_val not in data2_dict:
-            data2_dict[key_val] = []
-        data2_dict[key_val].append(doc2)
-
-    # 5. Join data on match_key
-    joined_data = []
-    for doc1 in data1:
-        doc1_key_value = doc1.get(match_key)
-        if doc1_key_value is None:
-            continue
-
-        # Get all docs in data2 that match this key
-        related_docs2 = data2_dict.get(doc1_key_value, [])
-        for doc2 in related_docs2:
-            merged_doc = {**doc1, **doc2}
-            joined_data.append(merged_doc)
-
-    # 6. Print results in table
-    print_results(f"Join between {collection1} and {collection2}", joined_data)
-
-    return joined_data
+    options = parse_argument(options, {})
+    joined = distributed_join(
+        dbms1_db, dbms2_db, collection1, collection2, match_key,
+        parse_argument(filter1, {}), parse_argument(filter2, {}),
+        strategy=options.get("strategy"),
+        explain=bool(options.get("explain", False)),
+    )
+
+    # Count the rows while they stream past the printer
+    joined_count = 0
+    def counted(documents):
+        nonlocal joined_count
+        for document in documents:
+            joined_count += 1
+            yield document
+
+    print_results_paged(f"Join between {collection1} and {collection2}", counted(joined),
+                        int(options.get("page_size", PAGE_SIZE)))
+    return joined_count
@@ -0,0 +1,194 @@
+import json
+from utils.query_router import route, shard_map
+from utils.scatter_gather import scatter_gather
+from utils.streaming_find import parse_sort, with_tiebreak, MergeKey
+
+# Two-phase aggregation over the shards.
+#   Every shard runs a $group pipeline that returns one partial state per group:
+#   a document count, and per field a sum and number of numeric values (never
+#   an average, those can't be merged), a min, a max, or a KMV sketch for
+#   approximate distinct counts. The coordinator merges the partial states of
+#   all shards into the final metrics, so one row per group and shard is
+#   transferred instead of the raw documents.
+
+METRICS = ("count", "sum", "avg", "min", "max", "distinct")
+
+# Pseudo group field: the DBMS a document is stored on
+SHARD_FIELD = "_shard"
+
+# Smallest hashes kept per group for a distinct estimate (exact below this many values)
+KMV_SIZE = 1024
+
+# Hashes from $toHashedIndexKey are signed 64 bit integers
+HASH_RANGE = 2 ** 64
+
+def parse_group_by(group_by):
+    """Group fields as a list. Accepts "aid,_shard", a list, or "-"/None for a single group."""
+    if not group_by or group_by == "-":
+        return []
+    if isinstance(group_by, str):
+        return [field.strip() for field in group_by.split(",") if field.strip()]
+    return list(group_by)
+
+def parse_metrics(metrics):
+    """
+    Metrics as a list of (name, operator, field). Accepts "count,avg:readTimeLength"
+    or a list of such strings.
+    """
+    if isinstance(metrics, str):
+        metrics = metrics.split(",")
+    parsed = []
+    for metric in metrics or ["count"]:
+        operator, _, field = metric.strip().partition(":")
+        operator = operator.lower()
+        if operator not in METRICS:
+            raise ValueError(f"Unknown metric '{operator}', use one of {', '.join(METRICS)}")
+        if operator == "count":
+            parsed.append(("count", "count", None))
+        elif not field:
+            raise ValueError(f"Metric '{operator}' needs a field, e.g. {operator}:readTimeLength")
+        else:
+            parsed.append((f"{operator}({field})", operator, field))
+    return parsed
+
+def numeric(field):
+    # Most numbers are stored as strings ("readTimeLength": "42")
+    return {"$convert": {"input": f"${field}", "to": "double", "onError": None, "onNull": None}}
+
+def group_id(server_fields):
+    if not server_fields:
+        return None
+    return {f"g{i}": f"${field}" for i, field in enumerate(server_fields)}
+
+def partial_pipeline(filter_query, server_fields, value_fields, metrics):
+    """$group pipeline returning the partial count/sum/min/max states of every group."""
+    project = {f"g{i}": f"${field}" for i, field in enumerate(server_fields)}
+    project.update({f"v{j}": numeric(field) for j, field in enumerate(value_fields)})
+    project["_id"] = 0
+
+    group = {"_id": {f"g{i}": f"$g{i}" for i in range(len(server_fields))} or None, "count": {"$sum": 1}}
+    for _, operator, field in metrics:
+        if field is None or operator == "distinct":
+            continue
+        j = value_fields.index(field)
+        if operator in ("sum", "avg"):
+            group[f"s{j}"] = {"$sum": f"$v{j}"}
+            group[f"n{j}"] = {"$sum": {"$cond": [{"$isNumber": f"$v{j}"}, 1, 0]}}
+        else:
+            group[f"{operator}{j}"] = {f"${operator}": f"$v{j}"}
+    return [{"$match": filter_query}, {"$project": project}, {"$group": group}]
+
+def sketch_pipeline(filter_query, server_fields, field):
+    """$group pipeline returning the KMV_SIZE smallest distinct hashes of field per group."""
+    distinct_values = {**(group_id(server_fields) or {}), "h": {"$toHashedIndexKey": f"${field}"}}
+    return [
+        {"$match": {"$and": [filter_query, {field: {"$ne": None}}]}},
+        {"$group": {"_id": distinct_values}},
+        {"$group": {
+            "_id": {f"g{i}": f"$_id.g{i}" for i in range(len(server_fields))} or None,
+            "hashes": {"$minN": {"input": "$_id.h", "n": KMV_SIZE}},
+        }},
+    ]
+
+def hashable(value):
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, sort_keys=True, default=str)
+    return value
+
+def kmv_estimate(hashes):
+    """Distinct count from the smallest hashes of a set (exact if fewer than KMV_SIZE)."""
+    if len(hashes) < KMV_SIZE:
+        return len(hashes)
+    kth = sorted(hashes)[KMV_SIZE - 1]
+    return round((KMV_SIZE - 1) / ((kth + HASH_RANGE // 2 + 1) / HASH_RANGE))
+
+def run_partials(db, collection_name, filter_query, server_fields, value_fields, metrics):
+    """The partial rows of one shard: (group values, state) pairs."""
+    collection = db[collection_name]
+    partials = []
+    for row in collection.aggregate(partial_pipeline(filter_query, server_fields, value_fields, metrics)):
+        values = tuple((row["_id"] or {}).get(f"g{i}") for i in range(len(server_fields)))
+        partials.append((values, row))
+    for field in {field for _, operator, field in metrics if operator == "distinct"}:
+        for row in collection.aggregate(sketch_pipeline(filter_query, server_fields, field)):
+            values = tuple((row["_id"] or {}).get(f"g{i}") for i in range(len(server_fields)))
+            partials.append((values, {"field": field, "hashes": row["hashes"]}))
+    return partials
+
+def merge_state(state, partial, value_fields):
+    if "hashes" in partial:
+        state["hashes"].setdefault(partial["field"], set()).update(partial["hashes"])
+        return
+    state["count"] += partial["count"]
+    for j in range(len(value_fields)):
+        if f"s{j}" in partial:
+            state["sum"][j] = state["sum"].get(j, 0) + (partial[f"s{j}"] or 0)
+            state["n"][j] = state["n"].get(j, 0) + partial[f"n{j}"]
+        for operator, pick in (("min", min), ("max", max)):
+            value = partial.get(f"{operator}{j}")
+            if value is not None:
+                current = state[operator].get(j)
+                state[operator][j] = value if current is None else pick(current, value)
+
+def final_metrics(state, value_fields, metrics):
+    row = {}
+    for name, operator, field in metrics:
+        if operator == "count":
+            row[name] = state["count"]
+        elif operator == "distinct":
+            row[name] = kmv_estimate(state["hashes"].get(field, ()))
+        else:
+            j = value_fields.index(field)
+            if operator == "sum":
+                row[name] = state["sum"].get(j, 0) if state["n"].get(j) else None
+            elif operator == "avg":
+                row[name] = state["sum"][j] / state["n"][j] if state["n"].get(j) else None
+            else:
+                row[name] = state[operator].get(j)
+    return row
+
+def distributed_aggregate(dbms1_db, dbms2_db, collection_name, group_by=None, metrics="count",
+                          filter_query=None, sort=None, limit=None, explain=False):
+    """
+    Rows of group values and metrics for the documents of a collection matching
+    filter_query, grouped by group_by (see parse_group_by and parse_metrics).
+    Rows are sorted by sort ("-count", default: the group fields) and cut to limit.
+    """
+    filter_query = filter_query or {}
+    group_fields = parse_group_by(group_by)
+    metrics = parse_metrics(metrics)
+    server_fields = [field for field in group_fields if field != SHARD_FIELD]
+    value_fields = list(dict.fromkeys(field for _, operator, field in metrics if field and operator != "distinct"))
+
+    shards = shard_map(dbms1_db, dbms2_db)
+    targets = route(dbms1_db, dbms2_db, collection_name, filter_query, explain, "aggregate")
+    results = scatter_gather({
+        shard: (lambda db=shards[shard]: run_partials(db, collection_name, filter_query, server_fields, value_fields, metrics))
+        for shard in targets
+    })
+
+    # Merge the partial states of all shards per group
+    states = {}
+    for shard in targets:
+        partials = results.get(shard, [])
+        if explain:
+            print(f"Explain: {shard} returned {len(partials)} partial rows")
+        for values, partial in partials:
+            values = iter(values)
+            key_values = tuple(shard if field == SHARD_FIELD else next(values) for field in group_fields)
+            key = tuple(hashable(value) for value in key_values)
+            if key not in states:
+                states[key] = (key_values, {"count": 0, "sum": {}, "n": {}, "min": {}, "max": {}, "hashes": {}})
+            merge_state(states[key][1], partial, value_fields)
+
+    rows = []
+    for key_values, state in states.values():
+        row = dict(zip(group_fields, key_values))
+        row.update(final_metrics(state, value_fields, metrics))
+        rows.append(row)
+
+    # The group fields break ties, so rows come out in the same order whatever the shards return
+    sort_spec = with_tiebreak(parse_sort(sort), group_fields)
+    if sort_spec:
+        rows.sort(key=lambda row: MergeKey(row, sort_spec))
+    return rows[:int(limit)] if limit is not None else rows
@@ -0,0 +1,195 @@
+import os
+from utils.query_router import route, shard_map
+from utils.scatter_gather import scatter_gather
+from utils.streaming_find import ShardedFind
+
+# Distributed equi-join of two collections.
+#   Three strategies, picked from cheap per-shard count estimates:
+#     colocated  Both collections are partitioned on the join key (User and Read
+#                on uid), so every shard joins its own documents with a $lookup
+#                pipeline and only joined rows leave the DBMS.
+#     semi-join  The smaller side is fetched and its distinct keys are sent to the
+#                other side in chunked $in queries, so only matching documents of
+#                the larger side are transferred and no $in hits the BSON limit.
+#     broadcast  The smaller side is fetched into a hash table and the larger side
+#                is streamed past it, for when the smaller side has about as many
+#                keys as the larger one has documents and a semi-join saves nothing.
+#   Joined documents are yielded one at a time, never collected into a list.
+
+# Values per $in query of a semi-join
+JOIN_BATCH_SIZE = int(os.getenv("JOIN_BATCH_SIZE", 1000))
+
+# Count estimates stop at this many documents per shard
+JOIN_COUNT_LIMIT = 100000
+
+# A semi-join is used while the smaller side has fewer than this fraction of
+# the larger side's documents (each $in chunk costs a round trip per shard)
+SEMI_JOIN_RATIO = 0.5
+
+# Pairs of collections that are partitioned on the same key (their $lookup
+# uses the indexes on that key from INDEX_CATALOG in utils/indexes.py)
+COLOCATED_JOINS = {frozenset(("User", "Read")): "uid"}
+
+STRATEGIES = ("colocated", "semi-join", "broadcast")
+
+def estimate_count(shards, targets, collection_name, filter_query):
+    """Estimated number of matching documents over the target shards."""
+    def shard_count(db):
+        collection = db[collection_name]
+        if not filter_query:
+            return collection.estimated_document_count()
+        return collection.count_documents(filter_query, limit=JOIN_COUNT_LIMIT)
+
+    counts = scatter_gather({shard: (lambda db=shards[shard]: shard_count(db)) for shard in targets})
+    return sum(counts.values())
+
+def with_key_values(filter_query, match_key, values):
+    """filter_query restricted to documents whose match_key is one of values."""
+    key_filter = {match_key: {"$in": values}}
+    if not filter_query:
+        return key_filter
+    if match_key in filter_query:
+        return {"$and": [filter_query, key_filter]}
+    return {**filter_query, **key_filter}
+
+def prefix_filter(filter_query, prefix):
+    """A filter on documents embedded under prefix (for matching $lookup results)."""
+    prefixed = {}
+    for field, condition in filter_query.items():
+        if field in ("$and", "$or", "$nor"):
+            prefixed[field] = [prefix_filter(sub_filter, prefix) for sub_filter in condition]
+        elif field.startswith("$"):
+            prefixed[field] = condition
+        else:
+            prefixed[f"{prefix}.{field}"] = condition
+    return prefixed
+
+def merge_documents(left, right):
+    # Fields of the right (collection2) document win, like before
+    return {**left, **right}
+
+def choose_strategy(collection1, collection2, match_key, count1, count2):
+    """Strategy name for a join with the given side estimates."""
+    if COLOCATED_JOINS.get(frozenset((collection1, collection2))) == match_key:
+        return "colocated"
+    small, large = sorted((count1, count2))
+    if small < large * SEMI_JOIN_RATIO:
+        return "semi-join"
+    return "broadcast"
+
+def colocated_join(shards, targets, collection1, collection2, match_key, filter1, filter2):
+    """Join on every shard with $lookup; each shard's joined rows are streamed back."""
+    pipeline = [
+        {"$match": filter1},
+        {"$lookup": {"from": collection2, "localField": match_key, "foreignField": match_key, "as": "_joined"}},
+        {"$unwind": "$_joined"},
+    ]
+    if filter2:
+        pipeline.append({"$match": prefix_filter(filter2, "_joined")})
+
+    for shard in targets:
+        for document in shards[shard][collection1].aggregate(pipeline, batchSize=JOIN_BATCH_SIZE):
+            joined = document.pop("_joined")
+            yield merge_documents(document, joined)
+
+def colocated_distinct(shards, targets, collection1, collection2, match_key, filter1, field):
+    """
+    Distinct values of a collection2 field over the documents joined to the matching
+    collection1 documents, computed inside every shard concurrently. Only one row per
+    distinct value and shard is transferred.
+    """
+    pipeline = [
+        {"$match": filter1},
+        {"$project": {"_id": 0, match_key: 1}},
+        {"$lookup": {"from": collection2, "localField": match_key, "foreignField": match_key, "as": "_joined"}},
+        {"$unwind": "$_joined"},
+        {"$group": {"_id": f"$_joined.{field}"}},
+    ]
+    def shard_values(db):
+        return [row["_id"] for row in db[collection1].aggregate(pipeline)]
+
+    results = scatter_gather({shard: (lambda db=shards[shard]: shard_values(db)) for shard in targets})
+    return {value for shard in targets for value in results.get(shard, []) if value is not None}
+
+def build_hash_table(shards, targets, collection_name, filter_query, match_key):
+    """match_key value -> documents, for the matching documents of the build side."""
+    table = {}
+    for document in ShardedFind(shards, targets, collection_name, filter_query, batch_size=JOIN_BATCH_SIZE):
+        key_value = document.get(match_key)
+        if key_value is not None:
+            table.setdefault(key_value, []).append(document)
+    return table
+
+def probe(table, document, match_key, build_is_left):
+    for match in table.get(document.get(match_key), ()):
+        yield merge_documents(match, document) if build_is_left else merge_documents(document, match)
+
+def semi_join(dbms1_db, dbms2_db, shards, build, probe_side, match_key, build_is_left):
+    """Fetch the build side, then only the probe documents whose key is in it (chunked $in)."""
+    build_name, build_filter, build_targets = build
+    probe_name, probe_filter = probe_side
+    table = build_hash_table(shards, build_targets, build_name, build_filter, match_key)
+
+    keys = list(table)
+    for start in range(0, len(keys), JOIN_BATCH_SIZE):
+        chunk_filter = with_key_values(probe_filter, match_key, keys[start:start + JOIN_BATCH_SIZE])
+        # Keys can pin the probe side's partition key (uid of Read), pruning shards per chunk
+        chunk_targets = route(dbms1_db, dbms2_db, probe_name, chunk_filter)
+        for document in ShardedFind(shards, chunk_targets, probe_name, chunk_filter, batch_size=JOIN_BATCH_SIZE):
+            yield from probe(table, document, match_key, build_is_left)
+
+def broadcast_join(shards, build, probe_side, match_key, build_is_left):
+    """Fetch the build side into a hash table and stream the whole probe side past it."""
+    build_name, build_filter, build_targets = build
+    probe_name, probe_filter, probe_targets = probe_side
+    table = build_hash_table(shards, build_targets, build_name, build_filter, match_key)
+    if not table:
+        return
+
+    probe_filter = {**probe_filter, match_key: {"$exists": True}} if match_key not in probe_filter else probe_filter
+    for document in ShardedFind(shards, probe_targets, probe_name, probe_filter, batch_size=JOIN_BATCH_SIZE):
+        yield from probe(table, document, match_key, build_is_left)
+
+def distributed_join(dbms1_db, dbms2_db, collection1, collection2, match_key,
+                     filter1=None, filter2=None, strategy=None, explain=False):
+    """
+    Generator of the documents of collection1 joined with collection2 on match_key
+    (fields of collection2 win on conflicts). strategy forces one of STRATEGIES,
+    by default it is chosen from count estimates. explain prints the plan.
+    """
+    filter1 = filter1 or {}
+    filter2 = filter2 or {}
+    shards = shard_map(dbms1_db, dbms2_db)
+    targets1 = route(dbms1_db, dbms2_db, collection1, filter1)
+    targets2 = route(dbms1_db, dbms2_db, collection2, filter2)
+
+    count1 = estimate_count(shards, targets1, collection1, filter1)
+    count2 = estimate_count(shards, targets2, collection2, filter2)
+    if strategy is None:
+        strategy = choose_strategy(collection1, collection2, match_key, count1, count2)
+    if strategy not in STRATEGIES:
+        raise ValueError(f"Unknown join strategy '{strategy}', use one of {', '.join(STRATEGIES)}")
+    if strategy == "colocated" and COLOCATED_JOINS.get(frozenset((collection1, collection2))) != match_key:
+        raise ValueError(f"'{collection1}' and '{collection2}' are not partitioned on '{match_key}'")
+
+    # The smaller side is the one held in memory
+    build_is_left = count1 <= count2
+    if explain:
+        build_side = collection1 if build_is_left else collection2
+        print(f"Explain: join {collection1} (~{count1} on {', '.join(targets1) or 'no shards'}) with "
+              f"{collection2} (~{count2} on {', '.join(targets2) or 'no shards'}) on '{match_key}' "
+              f"using {strategy}" + ("" if strategy == "colocated" else f", building on {build_side}"))
+
+    if strategy == "colocated":
+        # Matching documents of both sides are on the same shard, so only shards both sides target
+        targets = tuple(shard for shard in targets1 if shard in targets2)
+        yield from colocated_join(shards, targets, collection1, collection2, match_key, filter1, filter2)
+        return
+
+    left = (collection1, filter1, targets1)
+    right = (collection2, filter2, targets2)
+    build, probe_side = (left, right) if build_is_left else (right, left)
+    if strategy == "semi-join":
+        yield from semi_join(dbms1_db, dbms2_db, shards, build, probe_side[:2], match_key, build_is_left)
+    else:
+        yield from broadcast_join(shards, build, probe_side, match_key, build_is_left)
@@ -0,0 +1,125 @@
+from pymongo import IndexModel, ASCENDING, DESCENDING
+from concurrent.futures import ThreadPoolExecutor
+from utils.be_read import ROLLUP_COLLECTION
+
+# Index catalog of the distributed collections.
+#   The same indexes exist on both DBMS. They are created after the bulk load
+#   (building an index once is much cheaper than maintaining it during millions
+#   of inserts) and cover the fields the queries, joins and routing lookups filter on.
+
+INDEX_CATALOG = {
+    "User": [
+        [("uid", ASCENDING)],
+        [("region", ASCENDING)],
+    ],
+    "Article": [
+        [("aid", ASCENDING)],
+        [("category", ASCENDING)],
+    ],
+    "Read": [
+        [("uid", ASCENDING)],           # Reads of a user, User-Read $lookup
+        [("aid", ASCENDING)],           # Reads of an article
+        [("timestamp", DESCENDING)],    # Recent reads
+    ],
+    "Be-Read": [
+        [("aid", ASCENDING)],
+        [("timestamp", DESCENDING)],
+        [("readNum", DESCENDING)],      # top Be-Read readNum
+    ],
+    "Popular-Rank": [
+        [("temporalGranularity", ASCENDING), ("version", DESCENDING)],  # Versions of a ranking
+    ],
+    ROLLUP_COLLECTION: [
+        [("day", ASCENDING), ("aid", ASCENDING)],  # Windows of days, upserts of one day
+    ],
+}
+
+def index_name(keys):
+    """The name MongoDB gives an index on keys by default, e.g. "uid_1"."""
+    return "_".join(f"{field}_{direction}" for field, direction in keys)
+
+def catalog_spec(catalog=INDEX_CATALOG):
+    """collection -> index names, used as the inputs of the setup stage."""
+    return {collection: sorted(index_name(keys) for keys in indexes) for collection, indexes in catalog.items()}
+
+def apply_indexes(databases, catalog=INDEX_CATALOG):
+    """
+    Create the catalog's indexes on every database (concurrently per database/collection).
+    Existing indexes are left alone. Returns True if all were created.
+    """
+    def create(db, collection_name, indexes):
+        db[collection_name].create_indexes([IndexModel(keys, name=index_name(keys)) for keys in indexes])
+        return f"Indexed {db.name} '{collection_name}' on {', '.join(index_name(keys) for keys in indexes)}"
+
+    try:
+        with ThreadPoolExecutor(max_workers=len(databases) * len(catalog)) as executor:
+            futures = [
+                executor.submit(create, db, collection_name, indexes)
+                for db in databases
+                for collection_name, indexes in catalog.items()
+            ]
+            for future in futures:
+                print(future.result())
+        return True
+    except Exception as e:
+        print(f"Error creating indexes: {e}")
+        return False
+
+def drop_indexes(databases, catalog=INDEX_CATALOG):
+    """Drop the catalog's indexes, so a bulk load doesn't have to maintain them."""
+    for db in databases:
+        existing_collections = set(db.list_collection_names())
+        for collection_name, indexes in catalog.items():
+            if collection_name not in existing_collections:
+                continue
+            existing = set(db[collection_name].index_information())
+            for keys in indexes:
+                if index_name(keys) in existing:
+                    db[collection_name].drop_index(index_name(keys))
+
+def list_indexes(databases, catalog=INDEX_CATALOG):
+    """database -> collection -> index names, for the collections in the catalog."""
+    return {
+        db.name: {collection_name: sorted(db[collection_name].index_information()) for collection_name in catalog}
+        for db in databases
+    }
+
+# --------------- Query plans ---------------
+
+def plan_stages(plan):
+    """The stages of a winning plan from the root down, e.g. "LIMIT > FETCH > IXSCAN uid_1"."""
+    # Plans of the slot based engine wrap the classic plan in queryPlan
+    plan = plan.get("queryPlan", plan)
+    stages = []
+    while plan:
+        stage = plan.get("stage", "?")
+        if plan.get("indexName"):
+            stage += f" {plan['indexName']}"
+        stages.append(stage)
+        if "inputStage" in plan:
+            plan = plan["inputStage"]
+        elif plan.get("inputStages"):
+            stages.append("(" + " | ".join(plan_stages(sub_plan) for sub_plan in plan["inputStages"]) + ")")
+            break
+        else:
+            break
+    return " > ".join(stages)
+
+def explain_find(db, collection_name, filter_query, sort=None, limit=None, projection=None):
+    """Summary of the executed plan of a find on one DBMS."""
+    find = {"find": collection_name, "filter": filter_query}
+    if sort:
+        find["sort"] = dict(sort)
+    if limit:
+        find["limit"] = int(limit)
+    if projection:
+        find["projection"] = projection
+    explained = db.command({"explain": find, "verbosity": "executionStats"})
+    stats = explained.get("executionStats", {})
+    return {
+        "winningPlan": plan_stages(explained.get("queryPlanner", {}).get("winningPlan", {})),
+        "nReturned": stats.get("nReturned"),
+        "totalKeysExamined": stats.get("totalKeysExamined"),
+        "totalDocsExamined": stats.get("totalDocsExamined"),
+        "executionTimeMillis": stats.get("executionTimeMillis"),
+    }
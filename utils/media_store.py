@@ -0,0 +1,78 @@
+import os
+import hashlib
+
+# Deduplicating media storage on top of GridFS.
+#   Every distinct file content is stored once as a blob, a GridFS file named
+#   "blob-<sha256>" with {"sha256": ...} as metadata. The media filenames the
+#   articles refer to (text_a1.txt, image_a1_0.jpg, ...) are small alias
+#   documents pointing to a blob:
+#       {"filename": "image_a1_0.jpg", "blob_id": ..., "sha256": ..., "length": ...}
+#   Files uploaded before the aliases existed are still found by their filename.
+
+ALIAS_COLLECTION = "media_aliases"
+HASH_CHUNK_SIZE = 1024 * 1024
+
+def hash_file(path):
+    """sha256 hex digest of a file's content."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def blob_filename(sha256):
+    return f"blob-{sha256}"
+
+def ensure_alias_index(db):
+    db[ALIAS_COLLECTION].create_index("filename", unique=True)
+
+def existing_blobs(db):
+    """sha256 -> file id of every blob in GridFS, fetched with one query."""
+    cursor = db["fs.files"].find({"metadata.sha256": {"$exists": True}}, {"metadata.sha256": 1})
+    return {f["metadata"]["sha256"]: f["_id"] for f in cursor}
+
+def existing_filenames(db):
+    """Every media filename that can be read: the aliases plus files stored under their own name."""
+    filenames = {a["filename"] for a in db[ALIAS_COLLECTION].find({}, {"filename": 1, "_id": 0})}
+    legacy = db["fs.files"].find({"metadata.sha256": {"$exists": False}}, {"filename": 1, "_id": 0})
+    filenames.update(f["filename"] for f in legacy)
+    return filenames
+
+def count_media(db):
+    """Number of media filenames stored through aliases."""
+    return db[ALIAS_COLLECTION].estimated_document_count()
+
+def put_blob(bucket, sha256, path):
+    """Store the content of path as the blob for sha256 and return its file id."""
+    with open(path, "rb") as file:
+        return bucket.put(file, filename=blob_filename(sha256), metadata={"sha256": sha256})
+
+def alias_document(filename, blob_id, sha256, length):
+    return {"filename": filename, "blob_id": blob_id, "sha256": sha256, "length": length}
+
+def put_media(db, bucket, filename, path):
+    """Store the file at path under filename, uploading its content only if no blob has it yet."""
+    sha256 = hash_file(path)
+    blob = db["fs.files"].find_one({"metadata.sha256": sha256}, {"_id": 1})
+    blob_id = blob["_id"] if blob else put_blob(bucket, sha256, path)
+    db[ALIAS_COLLECTION].update_one(
+        {"filename": filename},
+        {"$set": alias_document(filename, blob_id, sha256, os.path.getsize(path))},
+        upsert=True,
+    )
+    return blob_id
+
+def media_exists(db, bucket, filename):
+    return db[ALIAS_COLLECTION].count_documents({"filename": filename}, limit=1) > 0 or \
+        bucket.exists({"filename": filename})
+
+def read_media(db, bucket, filename):
+    """Content of a media file (through its alias if it has one), or None if it doesn't exist."""
+    alias = db[ALIAS_COLLECTION].find_one({"filename": filename}, {"blob_id": 1})
+    if alias is not None:
+        return bucket.get(alias["blob_id"]).read()
+
+    file = bucket.find_one({"filename": filename})
+    if file is not None:
+        return file.read()
+    return None
@@ -0,0 +1,242 @@
+import os
+import time
+import threading
+from datetime import datetime, timedelta
+from pymongo.errors import DuplicateKeyError
+from utils.query_router import route, shard_map
+from utils.popularity import top_articles_in_window, parse_day
+from utils.result_cache import result_cache
+
+# Versioned Popular-Rank entries behind a "latest" pointer.
+#   Every refresh that changes a ranking inserts a new Popular-Rank entry with
+#   the next version of its granularity, then moves the granularity's pointer
+#   (one document, keyed by the granularity) to it in a single update. Readers
+#   only fetch the pointer, which carries the ranking, so they never see a half
+#   written ranking and never wait for a refresh. Pointers and entries live on
+#   the DBMS of their granularity (daily on DBMS1, every other one on DBMS2).
+#   A refresh only recomputes the windows that moved to other days or contain
+#   days whose rollups were written since (as recorded by update_be_read), and
+#   the long windows at most every MIN_REFRESH_SECONDS.
+
+# Pointer to the latest ranking of every granularity (_id is the granularity)
+POPULAR_RANK_LATEST = "Popular-Rank-Latest"
+
+# Seconds between two refreshes of the rankings
+POPULAR_RANK_REFRESH_SECONDS = float(os.getenv("POPULAR_RANK_REFRESH_SECONDS", 60))
+
+# Versions of a granularity kept next to the latest one
+POPULAR_RANK_VERSIONS = int(os.getenv("POPULAR_RANK_VERSIONS", 10))
+
+# Refreshes of this process run one at a time (setup and the scheduler)
+_refresh_lock = threading.Lock()
+
+# Days of every granularity, ending today
+TEMPORAL_RANGES = {
+    "daily": timedelta(days=1),
+    "weekly": timedelta(weeks=1),
+    "monthly": timedelta(days=30),
+    "20years": timedelta(weeks=1000),
+}
+
+# Seconds the ranking of a granularity may lag behind changed rollups. The long
+# windows group every day bucket they cover, and a few more reads barely move them.
+MIN_REFRESH_SECONDS = {"daily": 0, "weekly": 0, "monthly": 600, "20years": 3600}
+
+class RollupChanges:
+    """Days whose rollups were written through dbms_utils, with the sequence number of their last write."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sequence = 0
+        self._days = {}
+
+    def mark(self, days):
+        with self._lock:
+            self._sequence += 1
+            for day in days:
+                self._days[day] = self._sequence
+
+    def sequence(self):
+        with self._lock:
+            return self._sequence
+
+    def changed_since(self, sequence, start_day, end_day):
+        """Whether a day from start_day to end_day was written after sequence."""
+        with self._lock:
+            return any(start_day <= day <= end_day and written > sequence for day, written in self._days.items())
+
+# Rollup writes of this process
+rollup_changes = RollupChanges()
+
+# granularity -> (changes sequence, start day, end day, monotonic time) of its last recompute
+_recomputed = {}
+
+def rank_db(dbms1_db, dbms2_db, temporal_granularity):
+    """The database holding the rankings of a granularity."""
+    shard = route(dbms1_db, dbms2_db, "Popular-Rank", {"temporalGranularity": temporal_granularity})[0]
+    return shard_map(dbms1_db, dbms2_db)[shard]
+
+def latest_popular_rank(dbms1_db, dbms2_db, temporal_granularity):
+    """The latest ranking of a granularity (its pointer document), or None if there is none yet."""
+    db = rank_db(dbms1_db, dbms2_db, temporal_granularity)
+    return db[POPULAR_RANK_LATEST].find_one({"_id": temporal_granularity})
+
+def publish_popular_rank(db, temporal_granularity, article_aid_list, now, previous=None):
+    """
+    Insert a new version of a ranking and move the granularity's pointer to it.
+    Returns the new version, or None if a newer version was published meanwhile.
+    """
+    version = (previous or {}).get("version", 0) + 1
+    entry = {
+        "id": f"popular-{temporal_granularity}-{version}",
+        "version": version,
+        "timestamp": now.isoformat(),  # Convert to ISO 8601 string
+        "temporalGranularity": temporal_granularity,
+        "articleAidList": article_aid_list,
+    }
+    entry_id = db["Popular-Rank"].insert_one(entry).inserted_id
+
+    # Only move the pointer forward: the filter doesn't match a newer pointer,
+    # and the upsert then fails on its _id instead of replacing it
+    try:
+        db[POPULAR_RANK_LATEST].update_one(
+            {"_id": temporal_granularity, "version": {"$lt": version}},
+            {"$set": {
+                "version": version,
+                "id": entry["id"],
+                "timestamp": entry["timestamp"],
+                "refreshedAt": entry["timestamp"],
+                "temporalGranularity": temporal_granularity,
+                "articleAidList": article_aid_list,
+            }},
+            upsert=True,
+        )
+    except DuplicateKeyError:
+        db["Popular-Rank"].delete_one({"_id": entry_id})
+        return None
+
+    # Drop the versions nobody points to anymore
+    db["Popular-Rank"].delete_many({
+        "temporalGranularity": temporal_granularity,
+        "version": {"$lte": version - POPULAR_RANK_VERSIONS},
+    })
+    return version
+
+def refresh_popular_rank(dbms1_db, dbms2_db, now=None, should_print=False, force=False):
+    """
+    Recompute the ranking of every granularity that may be outdated (all of them
+    with force) from the per day rollups and publish the ones that changed (an
+    unchanged ranking only gets a new refreshedAt).
+    Returns granularity -> published version, for the rankings that changed.
+    """
+    now = now or datetime.now()
+    published = {}
+
+    try:
+        with _refresh_lock:
+            for granularity, time_delta in TEMPORAL_RANGES.items():
+                published_version = refresh_granularity(dbms1_db, dbms2_db, granularity, time_delta, now, should_print, force)
+                if published_version is not None:
+                    published[granularity] = published_version
+    finally:
+        # Also when a later granularity failed, the ones before it are published
+        if published:
+            result_cache.invalidate(["Popular-Rank"])
+    return published
+
+def is_outdated(granularity, start_day, end_day):
+    """Whether the last recompute of a granularity may not be its current ranking anymore."""
+    if granularity not in _recomputed:
+        return True
+    sequence, last_start, last_end, recomputed_at = _recomputed[granularity]
+    if (last_start, last_end) != (start_day, end_day):
+        return True
+    if time.monotonic() - recomputed_at < MIN_REFRESH_SECONDS.get(granularity, 0):
+        return False
+    return rollup_changes.changed_since(sequence, start_day, end_day)
+
+def refresh_granularity(dbms1_db, dbms2_db, granularity, time_delta, now, should_print=False, force=False):
+    """
+    Refresh the ranking of one granularity. Returns the published version, or None if it
+    didn't change. Raises ShardError, without publishing, if a DBMS fails or times out.
+    """
+    # Both ends are included, so a window of n days starts n - 1 days before today
+    start_day, end_day = parse_day(now - time_delta + timedelta(days=1)), parse_day(now)
+    if not force and not is_outdated(granularity, start_day, end_day):
+        return None
+
+    # Taken before the recompute, so rollups written during it are seen by the next refresh
+    sequence = rollup_changes.sequence()
+    db = rank_db(dbms1_db, dbms2_db, granularity)
+    previous = db[POPULAR_RANK_LATEST].find_one({"_id": granularity})
+    top_articles = [aid for aid, _ in top_articles_in_window(dbms1_db, dbms2_db, start_day, end_day)]
+    _recomputed[granularity] = (sequence, start_day, end_day, time.monotonic())
+
+    if top_articles == (previous or {}).get("articleAidList", []):
+        if previous:
+            db[POPULAR_RANK_LATEST].update_one({"_id": granularity}, {"$set": {"refreshedAt": now.isoformat()}})
+        elif should_print:
+            print(f"No Be-Read records found for {granularity} granularity.")
+        return None
+
+    version = publish_popular_rank(db, granularity, top_articles, now, previous)
+    if version is not None and should_print:
+        print(f"Inserted Popular-Rank entry for {granularity} granularity (version {version}).")
+    return version
+
+class PopularRankScheduler:
+    """
+    Background thread that refreshes the Popular-Rank rankings every interval seconds.
+    The first refresh runs right away. Failures are reported and retried at the next tick.
+    """
+
+    def __init__(self, interval=POPULAR_RANK_REFRESH_SECONDS):
+        self.interval = interval
+        self._thread = None
+        self._stop = threading.Event()
+        self.refreshes = 0
+        self.last_refresh = None
+        self.last_error = None
+
+    def start(self, dbms1_db, dbms2_db):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, args=(dbms1_db, dbms2_db), name="popular-rank-refresh", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """Stop the thread, after the refresh in progress if there is one."""
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def refresh(self, dbms1_db, dbms2_db):
+        try:
+            refresh_popular_rank(dbms1_db, dbms2_db)
+            self.refreshes += 1
+            self.last_refresh = time.time()
+            self.last_error = None
+        except Exception as e:
+            self.last_error = str(e)
+            print(f"Error refreshing Popular-Rank: {e}")
+
+    def _run(self, dbms1_db, dbms2_db):
+        while not self._stop.is_set():
+            self.refresh(dbms1_db, dbms2_db)
+            self._stop.wait(self.interval)
+
+    def stats(self):
+        return {
+            "running": bool(self._thread and self._thread.is_alive()),
+            "interval": self.interval,
+            "refreshes": self.refreshes,
+            "lastRefresh": self.last_refresh and datetime.fromtimestamp(self.last_refresh).isoformat(),
+            "lastError": self.last_error,
+        }
+
+# Scheduler of the main process
+popular_rank_scheduler = PopularRankScheduler()
@@ -0,0 +1,60 @@
+import heapq
+from datetime import datetime, timezone
+from utils.query_router import shard_map, ALL_SHARDS
+from utils.scatter_gather import scatter_gather_all
+from utils.be_read import ROLLUP_COLLECTION
+
+# Most popular articles of any time window, from the per day rollups.
+#   All rollups of an article are on the DBMS of its Be-Read row, so every shard
+#   can sum the day buckets of the window and rank its own articles exactly. Each
+#   shard returns only its top k ($group, $sort, $limit) and the coordinator keeps
+#   the k best of those with a heap. No reads are scanned.
+
+# Weights of the Be-Read metrics in the popularity score
+POPULARITY_WEIGHTS = {"readNum": 1, "commentNum": 3, "agreeNum": 2, "shareNum": 4}
+
+# Articles in a ranking
+TOP_ARTICLES = 5
+
+def parse_day(value):
+    """
+    "YYYY-MM-DD" (UTC) of a day given as "YYYY-MM-DD", epoch seconds or a datetime
+    (naive ones are taken as local time).
+    """
+    if isinstance(value, datetime):
+        return value.astimezone(timezone.utc).strftime("%Y-%m-%d")
+    if isinstance(value, (int, float)):
+        return datetime.fromtimestamp(value, timezone.utc).strftime("%Y-%m-%d")
+    try:
+        return datetime.strptime(str(value), "%Y-%m-%d").strftime("%Y-%m-%d")
+    except ValueError:
+        raise ValueError(f"Invalid day '{value}', expected YYYY-MM-DD")
+
+def window_pipeline(start_day, end_day, k):
+    """Per shard: the k articles with the highest score summed over the days of the window."""
+    score = {"$add": [{"$multiply": [f"${field}", weight]} for field, weight in POPULARITY_WEIGHTS.items()]}
+    return [
+        {"$match": {"day": {"$gte": start_day, "$lte": end_day}}},
+        {"$group": {"_id": "$aid", **{field: {"$sum": f"${field}"} for field in POPULARITY_WEIGHTS}}},
+        {"$project": {"score": score, **{field: 1 for field in POPULARITY_WEIGHTS}}},
+        {"$sort": {"score": -1, "_id": 1}},
+        {"$limit": k},
+    ]
+
+def top_articles_in_window(dbms1_db, dbms2_db, start_day, end_day, k=TOP_ARTICLES):
+    """
+    [(aid, score)] of the k most popular articles from start_day to end_day (inclusive),
+    best first. Raises ShardError if a DBMS fails or times out.
+    """
+    start_day, end_day = parse_day(start_day), parse_day(end_day)
+    pipeline = window_pipeline(start_day, end_day, int(k))
+    shards = shard_map(dbms1_db, dbms2_db)
+    # A ranking without one of the shards would be wrong, not partial
+    results = scatter_gather_all({
+        shard: (lambda db=shards[shard]: list(db[ROLLUP_COLLECTION].aggregate(pipeline)))
+        for shard in ALL_SHARDS
+    })
+    candidates = [row for shard in ALL_SHARDS for row in results[shard]]
+    # Highest score first, ties by aid like on the shards
+    best = heapq.nsmallest(int(k), candidates, key=lambda row: (-row["score"], row["_id"]))
+    return [(row["_id"], row["score"]) for row in best]
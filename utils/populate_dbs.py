@@ -1,7 +1,11 @@
-from datetime import datetime, timedelta
+from multiprocessing import Pool
+import os
+import time
 import json
-from pymongo import MongoClient
 from utils.dbms_utils import distribute_article, handle_insert, get_dbms_dbs
+from utils.be_read import aggregate_reads, merge_be_read_states, be_read_document, rollup_documents, ROLLUP_COLLECTION
+from utils.popularity import POPULARITY_WEIGHTS
+from utils.popular_rank import refresh_popular_rank
 
 def get_dbs():
     """ Get both databases. """
@@ -9,166 +13,141 @@ def get_dbs():
 
 def calculate_popularity_score(be_read_record):
     """Calculate a popularity score based on Be-Read metrics."""
-    return (be_read_record.get("readNum", 0) * 1 +
-            be_read_record.get("commentNum", 2) * 3 +
-            be_read_record.get("agreeNum", 0) * 2 +
-            be_read_record.get("shareNum", 0) * 4)
-
-def populate_popular_rank(be_read_data):
-    """Populate the Popular-Rank table based on Be-Read metrics using provided data."""
-    
-    # Define temporal ranges for granularity
-    temporal_ranges = {
-        "daily": timedelta(days=1),
-        "weekly": timedelta(weeks=1),
-        "monthly": timedelta(days=30),
-        "20years": timedelta(weeks=1000)
-    }
-    
-    # Use current timestamp
-    now = datetime.now()
+    return sum(be_read_record.get(field, 0) * weight for field, weight in POPULARITY_WEIGHTS.items())
+
+def populate_popular_rank(now=None):
+    """
+    Populate the Popular-Rank table from the per day rollups of Be-Read.
+    Every window counts the engagement of the days it covers (see utils/popularity.py),
+    and its ranking is published as a new version behind the latest pointer
+    (see utils/popular_rank.py), which the scheduler keeps refreshing afterwards.
+    """
     dbms1_db, dbms2_db = get_dbs()
-
-    for granularity, time_delta in temporal_ranges.items():
-        # Calculate the start time for the granularity
-        start_time = now - time_delta
-        start_time = int(start_time.timestamp())
-
-        # Filter Be-Read records based on timestamp
-        filtered_records = [record for record in be_read_data if int(record.get("timestamp", 0)) >= start_time]
-        
-        if not filtered_records:
-            print(f"No Be-Read records found for {granularity} granularity.")
-            continue
-        
-        # Calculate popularity scores
-        ranked_articles = []
-        for record in filtered_records:
-            popularity_score = calculate_popularity_score(record)
-            ranked_articles.append((record["aid"], popularity_score))
-        
-        # Sort articles by popularity score in descending order
-        ranked_articles.sort(key=lambda x: x[1], reverse=True)
-        
-        # Extract the top-5 articles
-        top_articles = [aid for aid, _ in ranked_articles[:5]]
-        
-        # Create the Popular-Rank entry
-        popular_rank_entry = {
-            "id": f"popular-{granularity}-{now.strftime('%Y%m%d%H%M%S')}",
-            "timestamp": now.isoformat(),  # Convert to ISO 8601 string
-            "temporalGranularity": granularity,
-            "articleAidList": top_articles
-        }
-        
-        # Insert Popular-Rank entry into the database or handle as needed
-        print(f"Inserted Popular-Rank entry for {granularity} granularity.")
-        
-        if(granularity == "daily"):
-            dbms1_db["Popular-Rank"].insert_one(popular_rank_entry)
-        else:
-            dbms2_db["Popular-Rank"].insert_one(popular_rank_entry)
-
-def populate_be_read_table(file_dir):
-    """Populate the Be-Read table based on the Read table."""
-    # Initialize a dictionary to store aggregated Be-Read data
-    articles = []
-    dbms1_db, dbms2_db = get_dbs()
-
-    # We load all articles into local memory to save time
+    return refresh_popular_rank(dbms1_db, dbms2_db, now, should_print=True, force=True)
+
+# Be-Read documents per insert_many
+BE_READ_BATCH_SIZE = 1000
+
+def byte_ranges(path, chunks):
+    """Split a file into about equal (start, end) byte ranges."""
+    size = os.path.getsize(path)
+    chunks = max(1, min(chunks, size))
+    bounds = [size * i // chunks for i in range(chunks + 1)]
+    return [(bounds[i], bounds[i + 1]) for i in range(chunks) if bounds[i] < bounds[i + 1]]
+
+def iter_range_lines(path, start, end):
+    """The lines of a file that start inside [start, end), so every line is in exactly one range."""
+    with open(path, "rb") as file:
+        if start:
+            # Skip the line that started before this range (when start is not a line start)
+            file.seek(start - 1)
+            file.readline()
+        position = file.tell()
+        while position < end:
+            line = file.readline()
+            if not line:
+                break
+            position += len(line)
+            yield line.decode()
+
+def aggregate_read_range(job):
+    """Map step: the per article states of the reads in one byte range of read.dat."""
+    path, start, end = job
+    return aggregate_reads(iter_range_lines(path, start, end))
+
+def load_article_categories(file_dir):
+    """aid -> category of every article in article.dat."""
     article_categories = {}
     with open(f"{file_dir}/article.dat", "r") as infile:
         for line in infile:
             article = json.loads(line)
-            articles.append(article)
             article_categories[article['aid']] = article.get('category', None)
+    return article_categories
+
+def write_be_read(states, article_categories, batch_size=BE_READ_BATCH_SIZE):
+    """
+    Insert the Be-Read documents and their per day rollups in batches: technology
+    articles on DBMS2, science articles spread 80/20 over DBMS1/DBMS2 (an article's
+    rollups go with its Be-Read row). Returns the Be-Read documents written.
+    """
+    dbms1_db, dbms2_db = get_dbs()
+    databases = {dbms1_db.name: dbms1_db, dbms2_db.name: dbms2_db}
+    batches = {(name, collection): [] for name in databases for collection in ("Be-Read", ROLLUP_COLLECTION)}
+    written = []
+
+    def add(name, collection, documents):
+        batches[(name, collection)].extend(documents)
+        if len(batches[(name, collection)]) >= batch_size:
+            flush((name, collection))
+
+    def flush(key):
+        if batches[key]:
+            name, collection = key
+            databases[name][collection].insert_many(batches[key], ordered=False)
+            batches[key] = []
+
+    for aid, state in states.items():
+        category = article_categories.get(aid)
+        if category == "technology":
+            db = dbms2_db
+        elif category == "science":
+            db = distribute_article(dbms1_db, dbms2_db)
+        else:
+            print(f"There is no article with aid: {aid}, skipping its reads.")
+            continue
 
-    # We now read all reads and process them
+        document = be_read_document(aid, state)
+        add(db.name, "Be-Read", [document])
+        add(db.name, ROLLUP_COLLECTION, rollup_documents(aid, state))
+        written.append(document)
+
+    for key in batches:
+        flush(key)
+    return written
+
+def populate_be_read_table(file_dir, workers=1):
+    """
+    Populate the Be-Read table based on the Read table.
+    read.dat is streamed line by line into per article aggregates (see aggregate_reads),
+    which only become documents when they are written. With several workers read.dat
+    is split into byte ranges that a process pool aggregates (map), and their partial
+    aggregates are merged (reduce) before writing.
+    """
     try:
-        with open(f"{file_dir}/read.dat", "r") as file:
-            # Each line in the file is a record
-            records = [json.loads(line) for line in file]
-
-            if not records:
-                print("No records found in read.dat. Skipping.")
-                return
-
-            # Initialize partition dictionaries
-            technology = {}
-            science = {}
-
-            # Process each record and aggregate the data
-            for record in records:
-                aid = record.get('aid')
-                uid = record.get('uid')
-                if not aid or not uid:
-                    continue  # Skip records without aid or uid
-
-                record_timestamp = int(record.get("timestamp", "0")[:10])  # Extract timestamp as integer
-
-                # Initialize if not already in dictionary
-                if aid not in technology and aid not in science:
-                    category = article_categories.get(aid)
-                    be_read_data = {
-                        "aid": aid,
-                        "readNum": 0,
-                        "readUidList": [],
-                        "commentNum": 0,
-                        "commentUidList": [],
-                        "agreeNum": 0,
-                        "agreeUidList": [],
-                        "shareNum": 0,
-                        "shareUidList": [],
-                        "timestamp": record_timestamp  # Initialize with the first timestamp
-                    }
-
-                    # Partition based on category
-                    if category == "science":
-                        science[aid] = be_read_data
-                    elif category == "technology":
-                        technology[aid] = be_read_data
-
-                # Select the correct partition
-                if aid in technology:
-                    current_partition = technology
-                else:
-                    current_partition = science
-
-                # Update metrics based on the current record
-                current_partition[aid]["readNum"] += 1
-                if uid not in current_partition[aid]["readUidList"]:
-                    current_partition[aid]["readUidList"].append(uid)
-
-                if record.get("commentOrNot"):
-                    current_partition[aid]["commentNum"] += 1
-                    if uid not in current_partition[aid]["commentUidList"]:
-                        current_partition[aid]["commentUidList"].append(uid)
-
-                if record.get("aggreeOrNot"):
-                    current_partition[aid]["agreeNum"] += 1
-                    if uid not in current_partition[aid]["agreeUidList"]:
-                        current_partition[aid]["agreeUidList"].append(uid)
-
-                if record.get("shareOrNot"):
-                    current_partition[aid]["shareNum"] += 1
-                    if uid not in current_partition[aid]["shareUidList"]:
-                        current_partition[aid]["shareUidList"].append(uid)
-
-                # Update the timestamp to the latest timestamp for this article
-                if "timestamp" in record and int(record_timestamp) > current_partition[aid]["timestamp"]:
-                    current_partition[aid]["timestamp"] = int(record_timestamp)
-
-        # After processing, upload partitions to the respective databases
-        print("Uploading technology articles to DBMS2...")
-        dbms2_db["Be-Read"].insert_many(list(technology.values()))
-
-        print("Distributing science articles between DBMS1 and DBMS2...")
-        for article in science.values():
-            selected_db = distribute_article(dbms1_db, dbms2_db)
-            selected_db["Be-Read"].insert_one(article)
+        # We load the article categories into local memory to save time
+        article_categories = load_article_categories(file_dir)
+        read_path = f"{file_dir}/read.dat"
+
+        # Map: aggregate all reads per article, in chunks when there are several workers
+        start = time.time()
+        reduce_time = 0.0
+        if workers > 1:
+            jobs = [(read_path, range_start, range_end) for range_start, range_end in byte_ranges(read_path, workers * 4)]
+            with Pool(workers) as pool:
+                # Reduce: merge the partial aggregates as the chunks finish
+                states = {}
+                for partial_states in pool.imap_unordered(aggregate_read_range, jobs):
+                    reduce_start = time.time()
+                    merge_be_read_states(states, partial_states)
+                    reduce_time += time.time() - reduce_start
+        else:
+            with open(read_path, "r") as file:
+                states = aggregate_reads(file)
+        aggregated = time.time()
+        print(f"Aggregated reads of {len(states)} articles with {workers} worker(s): "
+              f"map {aggregated - start - reduce_time:.2f}s, reduce {reduce_time:.2f}s.")
+
+        if not states:
+            print("No records found in read.dat. Skipping.")
+            return
+
+        # Upload technology articles to DBMS2 and distribute science articles between DBMS1 and DBMS2
+        print("Uploading Be-Read documents...")
+        be_read_data = write_be_read(states, article_categories)
+        print(f"Wrote {len(be_read_data)} Be-Read documents: write {time.time() - aggregated:.2f}s.")
 
         print("Be-Read table populated successfully with partitions.")
-        return list(technology.values()) + list(science.values())
+        return be_read_data
 
     except FileNotFoundError:
         print(f"File {file_dir}/read.dat not found.")
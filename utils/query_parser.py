@@ -0,0 +1,152 @@
+import ast
+import copy
+import json
+from dataclasses import dataclass
+from functools import lru_cache
+
+# Parser for the REPL commands.
+#   A query is a command followed by bare words (collection names, fields,
+#   numbers, granularities) and JSON values (filters, updates, documents,
+#   options), which may nest and use Mongo operators:
+#       find Read {"uid": {"$in": ["1", "2"]}} {"sort": "-timestamp"}
+#       join User Read uid {"region": "Beijing"} {}
+#   Values are only ever parsed as data (JSON, or Python literals for single
+#   quoted input), never evaluated as code. Compiled plans are cached by
+#   normalized query text, so repeated query shapes skip parsing entirely.
+
+PLAN_CACHE_SIZE = 512
+
+class QueryParseError(ValueError):
+    pass
+
+@dataclass(frozen=True)
+class QueryPlan:
+    command: str       # lowercased command, e.g. "find"
+    words: tuple       # bare words after the command, e.g. ("Read",)
+    arguments: tuple   # parsed JSON values after the command, in order
+
+    @property
+    def collection(self):
+        return self.words[0] if self.words else None
+
+    def word(self, index, default=None):
+        return self.words[index] if len(self.words) > index else default
+
+    def argument(self, index, default=None):
+        return self.arguments[index] if len(self.arguments) > index else default
+
+OPENING = {"{": "}", "[": "]"}
+
+def scan_value(text, start):
+    """End index (exclusive) of the bracketed value starting at text[start], respecting quoted strings."""
+    stack = []
+    quote = None
+    i = start
+    while i < len(text):
+        char = text[i]
+        if quote:
+            if char == "\\":
+                i += 1
+            elif char == quote:
+                quote = None
+        elif char in ("'", '"'):
+            quote = char
+        elif char in OPENING:
+            stack.append(OPENING[char])
+        elif char in ("}", "]"):
+            if not stack or stack.pop() != char:
+                raise QueryParseError(f"Unbalanced '{char}' at position {i}")
+            if not stack:
+                return i + 1
+        i += 1
+    raise QueryParseError(f"Unterminated value starting at position {start}")
+
+def parse_value(text):
+    """Parse a single JSON value (or a single quoted Python literal of data)."""
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError as json_error:
+        try:
+            value = ast.literal_eval(text)
+        except (ValueError, SyntaxError):
+            raise QueryParseError(f"Invalid value {text}: {json_error}")
+        if not isinstance(value, (dict, list, str, int, float, bool)) and value is not None:
+            raise QueryParseError(f"Invalid value {text}")
+        return value
+
+def normalize_query(text):
+    """Query text with whitespace outside of quoted strings collapsed, used as the cache key."""
+    normalized = []
+    quote = None
+    escaped = False
+    pending_space = False
+    for char in text.strip():
+        if quote:
+            normalized.append(char)
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == quote:
+                quote = None
+            continue
+        if char.isspace():
+            pending_space = True
+            continue
+        if pending_space:
+            normalized.append(" ")
+            pending_space = False
+        if char in ("'", '"'):
+            quote = char
+        normalized.append(char)
+    return "".join(normalized)
+
+@lru_cache(maxsize=PLAN_CACHE_SIZE)
+def compile_query(normalized_text):
+    """Compile normalized query text into a QueryPlan (cached)."""
+    words = []
+    arguments = []
+    i = 0
+    text = normalized_text
+    while i < len(text):
+        char = text[i]
+        if char.isspace():
+            i += 1
+        elif char in OPENING:
+            end = scan_value(text, i)
+            arguments.append(parse_value(text[i:end]))
+            i = end
+        elif char in ("'", '"'):
+            end = text.find(char, i + 1)
+            while end != -1 and text[end - 1] == "\\":
+                end = text.find(char, end + 1)
+            if end == -1:
+                raise QueryParseError(f"Unterminated string at position {i}")
+            words.append(parse_value(text[i:end + 1]))
+            i = end + 1
+        else:
+            end = i
+            while end < len(text) and not text[end].isspace() and text[end] not in OPENING:
+                end += 1
+            words.append(text[i:end])
+            i = end
+
+    if not words:
+        raise QueryParseError("Empty query")
+    return QueryPlan(command=words[0].lower(), words=tuple(words[1:]), arguments=tuple(arguments))
+
+def parse_query(text):
+    """
+    The QueryPlan of a query. The cached plan's arguments are copied, so
+    callers can't change the plan for the next query with the same text.
+    """
+    plan = compile_query(normalize_query(text))
+    return QueryPlan(plan.command, plan.words, copy.deepcopy(plan.arguments))
+
+def parse_argument(value, default=None):
+    """A filter/update/document given either as a value or as query text (None gives default)."""
+    if value is None:
+        return default
+    if isinstance(value, str):
+        return parse_value(value.strip()) if value.strip() else default
+    return value
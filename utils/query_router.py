@@ -0,0 +1,115 @@
+from utils.user_directory import user_directory
+
+# Partition-aware routing of queries to the DBMS that can hold matches.
+#   The rules mirror where split_data_by_database and upload_data_to_mongodb
+#   put documents. A filter that pins the partition key (equality, $eq, $in,
+#   possibly inside $and/$or) only goes to the shards those values live on.
+
+ALL_SHARDS = ("DBMS1", "DBMS2")
+
+# collection -> (partition key, value -> shards, shards for any other value)
+PARTITION_RULES = {
+    # Users are split by region
+    "User": ("region", {"Beijing": ("DBMS1",), "Hong Kong": ("DBMS2",)}, ALL_SHARDS),
+    # Technology articles are on DBMS2, science articles are spread over both
+    "Article": ("category", {"science": ALL_SHARDS, "technology": ("DBMS2",)}, ALL_SHARDS),
+    # Daily rankings are on DBMS1, every other granularity on DBMS2
+    "Popular-Rank": ("temporalGranularity", {"daily": ("DBMS1",)}, ("DBMS2",)),
+    # The latest ranking pointers live with their rankings
+    "Popular-Rank-Latest": ("temporalGranularity", {"daily": ("DBMS1",)}, ("DBMS2",)),
+}
+
+# Reads follow the region of their user, resolved through the user directory
+READ_REGION_SHARDS = {"Beijing": ("DBMS1",), "Hong Kong": ("DBMS2",)}
+
+def shard_map(dbms1_db, dbms2_db):
+    """Shard name -> database object."""
+    return {"DBMS1": dbms1_db, "DBMS2": dbms2_db}
+
+def pinned_values(condition):
+    """The values a filter condition restricts a field to, or None if it doesn't pin it."""
+    if isinstance(condition, dict):
+        if any(not key.startswith("$") for key in condition):
+            return None  # Embedded document equality
+        if "$eq" in condition:
+            return [condition["$eq"]]
+        if "$in" in condition and isinstance(condition["$in"], list):
+            return condition["$in"]
+        return None
+    if isinstance(condition, list):
+        return None  # Array equality
+    return [condition]
+
+def shards_for_values(dbms1_db, dbms2_db, collection_name, values):
+    """Shards that can hold documents of a collection whose partition key is one of values."""
+    if collection_name == "Read":
+        uid_regions = user_directory.lookup_many(dbms1_db, dbms2_db, values)
+        shards = set()
+        for uid in values:
+            # Reads of unknown users could have been stored anywhere
+            shards.update(READ_REGION_SHARDS.get(uid_regions.get(uid), ALL_SHARDS))
+        return shards
+
+    _, mapping, default = PARTITION_RULES[collection_name]
+    shards = set()
+    for value in values:
+        shards.update(mapping.get(value, default) if isinstance(value, str) else ALL_SHARDS)
+    return shards
+
+def partition_key(collection_name):
+    if collection_name == "Read":
+        return "uid"
+    if collection_name in PARTITION_RULES:
+        return PARTITION_RULES[collection_name][0]
+    return None
+
+def placement_fields(collection_name):
+    """
+    Fields that decide which shard a document of the collection is on. Changing
+    them in place would leave the document where routing no longer looks for it.
+    """
+    fields = set()
+    key = partition_key(collection_name)
+    if key:
+        fields.add(key)
+    if collection_name == "User":
+        # Reads are placed by the region of their user's uid
+        fields.add("uid")
+    return fields
+
+def candidate_shards(dbms1_db, dbms2_db, collection_name, filter_query):
+    """Set of shards that can hold documents matching filter_query."""
+    shards = set(ALL_SHARDS)
+    key = partition_key(collection_name)
+    if key is None or not isinstance(filter_query, dict):
+        return shards
+
+    for field, condition in filter_query.items():
+        if field == "$and" and isinstance(condition, list):
+            for sub_filter in condition:
+                shards &= candidate_shards(dbms1_db, dbms2_db, collection_name, sub_filter)
+        elif field == "$or" and isinstance(condition, list):
+            union = set()
+            for sub_filter in condition:
+                union |= candidate_shards(dbms1_db, dbms2_db, collection_name, sub_filter)
+            shards &= union
+        elif field == key:
+            values = pinned_values(condition)
+            if values is not None:
+                shards &= shards_for_values(dbms1_db, dbms2_db, collection_name, values)
+    return shards
+
+def route(dbms1_db, dbms2_db, collection_name, filter_query, explain=False, operation="find"):
+    """
+    Shard names (in DBMS1, DBMS2 order) an operation with this filter has to go to.
+    With explain the chosen shards are printed.
+    """
+    shards = candidate_shards(dbms1_db, dbms2_db, collection_name, filter_query)
+    targets = tuple(shard for shard in ALL_SHARDS if shard in shards)
+    if explain:
+        pruned = [shard for shard in ALL_SHARDS if shard not in targets]
+        key = partition_key(collection_name)
+        print(f"Explain: {operation} on '{collection_name}' (partition key: {key or 'none'}) "
+              f"targets {', '.join(targets) or 'no shards'}"
+              + (f", pruned {', '.join(pruned)}" if pruned else ""))
+    return targets
@@ -1,29 +1,26 @@
 import gridfs
-from pymongo import MongoClient
+from utils.connections import get_client
+from utils.media_store import read_media
 
 # MongoDB connection details
-MONGO_URI = "mongodb://localhost:27041"
 DATABASE_NAME = "UnifiedDB"
 
-# Connect to MongoDB and GridFS
+# Connect to MongoDB and GridFS (through the shared GFS client)
 def connect_to_gridfs():
-    client = MongoClient(MONGO_URI)
+    client = get_client("GFS")
     db = client[DATABASE_NAME]
     bucket = gridfs.GridFS(db)
-    return bucket
+    return db, bucket
 
 # Read a file into a variable
+#   The filename is resolved through its alias to the deduplicated blob
 def read_file_into_variable(filename):
-    bucket = connect_to_gridfs()
-    
-    # Check if the file exists in GridFS
-    if bucket.exists({"filename": filename}):
-        file = bucket.find_one({"filename": filename})
-        file_data = file.read()  # Read the file's content into a variable
-        return file_data
-    else:
+    db, bucket = connect_to_gridfs()
+
+    file_data = read_media(db, bucket, filename)  # Read the file's content into a variable
+    if file_data is None:
         print(f"File {filename} does not exist in GridFS.")
-        return None
+    return file_data
 
 # How to read a file:
 # text_text_a9981 = read_file_into_variable("text_a9981.txt")
@@ -0,0 +1,107 @@
+import os
+import json
+import time
+import threading
+from collections import OrderedDict
+
+# Seconds a cached result stays valid
+RESULT_CACHE_TTL = float(os.getenv("RESULT_CACHE_TTL_SECONDS", 300))
+
+# Approximate memory the cached results may take (least recently used ones are evicted)
+RESULT_CACHE_MAX_BYTES = int(os.getenv("RESULT_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+
+def approximate_size(value):
+    """Rough size of a result in bytes (its JSON length)."""
+    return len(json.dumps(value, default=str))
+
+class ResultCache:
+    """
+    Cache of assembled query results, with a TTL and a memory budget with LRU eviction.
+
+    Every entry records the collections it was computed from. Writes to one of
+    those collections through dbms_utils invalidate the entry, so a cached
+    result is never older than the last write, nor older than the TTL.
+    Invalidations also bump a generation per collection: a result computed while
+    one of its collections was invalidated (see generation) is not cached.
+    """
+
+    def __init__(self, max_bytes=RESULT_CACHE_MAX_BYTES, ttl=RESULT_CACHE_TTL):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (value, size, expires, collections)
+        self._size = 0
+        self._generations = {}  # collection -> number of invalidations
+        self._generation_all = 0  # number of invalidations of every collection
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _remove(self, key):
+        # Caller holds the lock
+        _, size, _, _ = self._entries.pop(key)
+        self._size -= size
+
+    def get(self, key):
+        """The cached value of key, or None if it is missing or expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[2] < time.monotonic():
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def _generation(self, collections):
+        # Caller holds the lock
+        return (self._generation_all, tuple(self._generations.get(name, 0) for name in sorted(collections)))
+
+    def generation(self, collections):
+        """Token to pass to put, taken before computing a result from collections."""
+        with self._lock:
+            return self._generation(collections)
+
+    def put(self, key, value, collections=(), size=None, generation=None):
+        """
+        Cache value under key until the TTL passes or one of collections is written.
+        With the generation taken before computing value, the value isn't cached if
+        one of collections was invalidated in the meantime.
+        """
+        size = approximate_size(value) if size is None else size
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if generation is not None and generation != self._generation(collections):
+                return
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, size, time.monotonic() + self.ttl, frozenset(collections))
+            self._size += size
+            while self._size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self, collections=None):
+        """Drop the entries computed from any of collections, or every entry if none are given."""
+        with self._lock:
+            if collections is None:
+                self._generation_all += 1
+                self._entries.clear()
+                self._size = 0
+                return
+            collections = set(collections)
+            for name in collections:
+                self._generations[name] = self._generations.get(name, 0) + 1
+            for key in [key for key, entry in self._entries.items() if entry[3] & collections]:
+                self._remove(key)
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self._size, "hits": self.hits, "misses": self.misses}
+
+# Cache shared by the whole process
+result_cache = ResultCache()
@@ -0,0 +1,68 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# Concurrent execution of per-shard work.
+#   Each shard's query runs on a shared thread pool, so a cross-DBMS read
+#   takes about as long as the slowest shard instead of the sum of all of them.
+
+# Seconds a shard gets before its results are given up on
+SHARD_TIMEOUT = float(os.getenv("SHARD_TIMEOUT_SECONDS", 30))
+
+_executor = ThreadPoolExecutor(max_workers=int(os.getenv("SCATTER_WORKERS", 16)), thread_name_prefix="scatter")
+
+def scatter(tasks):
+    """Start one callable per shard. tasks is shard -> callable, returns future -> shard."""
+    return {_executor.submit(task): shard for shard, task in tasks.items()}
+
+def gather(futures, timeout=SHARD_TIMEOUT):
+    """
+    Yield (shard, result) in the order the shards finish. Shards that fail or
+    don't finish within timeout are reported and left out.
+    """
+    deadline = time.monotonic() + timeout
+    pending = dict(futures)
+    while pending:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        done, _ = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+        for future in done:
+            shard = pending.pop(future)
+            try:
+                yield shard, future.result()
+            except Exception as e:
+                print(f"Error on {shard}: {e}")
+
+    for future, shard in pending.items():
+        future.cancel()
+        print(f"{shard} did not answer within {timeout} seconds, its results are missing.")
+
+def scatter_gather(tasks, timeout=SHARD_TIMEOUT):
+    """Run one callable per shard concurrently and return shard -> result for the shards that completed."""
+    return dict(gather(scatter(tasks), timeout))
+
+class ShardError(RuntimeError):
+    """Some shards failed or didn't answer in time."""
+
+def scatter_gather_all(tasks, timeout=SHARD_TIMEOUT):
+    """
+    Like scatter_gather, for work that is wrong without every shard (writes, and the
+    lookups deciding where they go): raises ShardError if any shard fails or times out.
+    """
+    futures = scatter(tasks)
+    _, not_done = wait(futures, timeout=timeout)
+    results = {}
+    errors = []
+    for future, shard in futures.items():
+        if future in not_done:
+            future.cancel()
+            errors.append(f"{shard} did not answer within {timeout} seconds")
+            continue
+        try:
+            results[shard] = future.result()
+        except Exception as e:
+            errors.append(f"{shard}: {e}")
+    if errors:
+        raise ShardError("; ".join(errors))
+    return results
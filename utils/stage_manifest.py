@@ -0,0 +1,151 @@
+import os
+import json
+import time
+import hashlib
+
+# Every setup stage (generate, partition, upload, Be-Read, Popular-Rank, media)
+# records a manifest of what it ran on and what it produced:
+#   {"stage": ..., "inputs": {...}, "outputs": {...}, "completed_at": ...}
+# A stage is skipped when its inputs are unchanged and its outputs still match.
+
+MANIFEST_DIR = "data/database/manifests"
+
+# Bytes hashed from the start and the end of a file for its checksum
+CHECKSUM_SAMPLE_SIZE = 1024 * 1024
+
+def fingerprint_file(path):
+    """
+    Size, mtime and checksum of a file, or None if it doesn't exist.
+    The checksum covers the first and last CHECKSUM_SAMPLE_SIZE bytes, so
+    fingerprinting a 100 GB dataset doesn't mean reading all of it.
+    """
+    if not os.path.isfile(path):
+        return None
+    stat = os.stat(path)
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        digest.update(f.read(CHECKSUM_SAMPLE_SIZE))
+        if stat.st_size > CHECKSUM_SAMPLE_SIZE:
+            f.seek(max(CHECKSUM_SAMPLE_SIZE, stat.st_size - CHECKSUM_SAMPLE_SIZE))
+            digest.update(f.read(CHECKSUM_SAMPLE_SIZE))
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "checksum": digest.hexdigest()}
+
+def fingerprint_files(paths):
+    """Fingerprints of several files, keyed by file name."""
+    return {os.path.basename(path): fingerprint_file(path) for path in paths}
+
+def count_entries(directory):
+    """Number of entries directly inside a directory (0 if it doesn't exist)."""
+    if not os.path.isdir(directory):
+        return 0
+    with os.scandir(directory) as entries:
+        return sum(1 for _ in entries)
+
+def fingerprint_tree(directory):
+    """
+    File count, total size and latest mtime of every subdirectory of a directory
+    ("." for the files directly inside it), so added, removed or replaced files
+    anywhere in the tree change the fingerprint without reading them.
+    """
+    fingerprint = {}
+    if not os.path.isdir(directory):
+        return fingerprint
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        relative = os.path.relpath(root, directory)
+        top = relative.split(os.sep)[0]
+        entry = fingerprint.setdefault(top, {"files": 0, "bytes": 0, "mtime": 0})
+        for name in files:
+            stat = os.stat(os.path.join(root, name))
+            entry["files"] += 1
+            entry["bytes"] += stat.st_size
+            entry["mtime"] = max(entry["mtime"], stat.st_mtime_ns)
+    return fingerprint
+
+def normalize(value):
+    """Round trip through JSON, so values compare equal to what was saved."""
+    return json.loads(json.dumps(value, sort_keys=True))
+
+def manifest_path(stage, manifest_dir=MANIFEST_DIR):
+    return os.path.join(manifest_dir, f"{stage}.json")
+
+def load_manifest(stage, manifest_dir=MANIFEST_DIR):
+    """The manifest of a stage, or None if it never completed."""
+    path = manifest_path(stage, manifest_dir)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError) as e:
+        print(f"Ignoring unreadable manifest {path}: {e}")
+        return None
+
+def save_manifest(stage, inputs, outputs, manifest_dir=MANIFEST_DIR):
+    """Write the manifest of a completed stage (atomically)."""
+    os.makedirs(manifest_dir, exist_ok=True)
+    manifest = {
+        "stage": stage,
+        "inputs": normalize(inputs),
+        "outputs": normalize(outputs),
+        "completed_at": time.time(),
+    }
+    path = manifest_path(stage, manifest_dir)
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(f"{path}.tmp", path)
+    return manifest
+
+def clear_manifest(stage, manifest_dir=MANIFEST_DIR):
+    path = manifest_path(stage, manifest_dir)
+    if os.path.exists(path):
+        os.remove(path)
+
+def manifest_digest(stage, manifest_dir=MANIFEST_DIR):
+    """
+    Digest of a completed stage's inputs and outputs, or None.
+    Downstream stages put this in their inputs, so they re-run when it re-runs with a different result.
+    """
+    manifest = load_manifest(stage, manifest_dir)
+    if manifest is None:
+        return None
+    content = json.dumps({"inputs": manifest["inputs"], "outputs": manifest["outputs"]}, sort_keys=True)
+    return hashlib.sha256(content.encode()).hexdigest()
+
+def run_stage(stage, inputs, run, count_outputs, manifest_dir=MANIFEST_DIR, adopt=None):
+    """
+    Run a setup stage unless it is already up to date.
+
+    inputs: JSON-able description of what the stage reads (checksums, sizes, upstream digests, parameters)
+    run: does the work, returns a truthy value on success
+    count_outputs: returns a JSON-able description of the stage's outputs (counts, fingerprints)
+    adopt: optional check for outputs made before manifests existed, to record them instead of re-running
+
+    Returns True if the stage was skipped or ran successfully.
+    """
+    inputs = normalize(inputs)
+    manifest = load_manifest(stage, manifest_dir)
+
+    if manifest is not None and manifest["inputs"] == inputs:
+        try:
+            outputs = normalize(count_outputs())
+        except Exception as e:
+            print(f"Could not verify the outputs of {stage}: {e}")
+            outputs = None
+        if outputs == manifest["outputs"]:
+            print(f"Skipping {stage}: inputs unchanged and outputs verified.")
+            return True
+        print(f"Re-running {stage}: its outputs don't match the manifest.")
+
+    elif manifest is None and adopt is not None and adopt():
+        save_manifest(stage, inputs, count_outputs(), manifest_dir)
+        print(f"Skipping {stage}: recorded the existing outputs.")
+        return True
+
+    clear_manifest(stage, manifest_dir)
+    start = time.time()
+    if not run():
+        return False
+    save_manifest(stage, inputs, count_outputs(), manifest_dir)
+    print(f"Stage {stage} completed in {time.time() - start:.2f} seconds.")
+    return True
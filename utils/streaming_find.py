@@ -0,0 +1,207 @@
+import json
+import heapq
+import base64
+from datetime import datetime
+from itertools import chain
+from bson import ObjectId
+from utils.scatter_gather import scatter_gather
+
+# Streaming, paginated find over several shards.
+#   Projection, sort and limit are pushed down to every shard. Sorted shard
+#   cursors are k-way merged, so memory stays bounded by the page size and the
+#   cursor batches no matter how many documents match. A cursor token records
+#   how many documents were consumed from each shard, so the next page resumes
+#   with a per-shard skip instead of re-reading everything before it.
+
+PAGE_SIZE = 50
+
+def parse_sort(sort):
+    """
+    Sort spec as a list of (field, direction). Accepts "-timestamp,uid",
+    {"timestamp": -1, "uid": 1} or [["timestamp", -1], ["uid", 1]].
+    """
+    if not sort:
+        return []
+    if isinstance(sort, str):
+        spec = []
+        for field in sort.split(","):
+            field = field.strip()
+            if field.startswith("-"):
+                spec.append((field[1:], -1))
+            elif field:
+                spec.append((field.lstrip("+"), 1))
+        return spec
+    if isinstance(sort, dict):
+        return [(field, -1 if int(direction) < 0 else 1) for field, direction in sort.items()]
+    return [(field, -1 if int(direction) < 0 else 1) for field, direction in sort]
+
+def parse_projection(projection):
+    """Projection as a dict. Accepts "uid,aid" or a Mongo projection document."""
+    if not projection:
+        return None
+    if isinstance(projection, str):
+        return {field.strip(): 1 for field in projection.split(",") if field.strip()}
+    return dict(projection)
+
+def encode_cursor(offsets, remaining):
+    content = json.dumps({"offsets": offsets, "remaining": remaining}, sort_keys=True)
+    return base64.urlsafe_b64encode(content.encode()).decode()
+
+def decode_cursor(token):
+    content = json.loads(base64.urlsafe_b64decode(token.encode()).decode())
+    return content["offsets"], content["remaining"]
+
+def field_value(document, path):
+    """Value of a (dotted) field, or None if it is missing."""
+    value = document
+    for part in path.split("."):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(part)
+    return value
+
+def bson_sort_value(value):
+    """Value ranked like MongoDB compares values of different types."""
+    if value is None:
+        return (0, 0)
+    if isinstance(value, bool):
+        return (8, value)
+    if isinstance(value, (int, float)):
+        return (1, value)
+    if isinstance(value, str):
+        return (2, value)
+    if isinstance(value, (dict, list)):
+        return (3, json.dumps(value, sort_keys=True, default=str))
+    if isinstance(value, ObjectId):
+        return (7, value)
+    if isinstance(value, datetime):
+        return (9, value)
+    return (10, str(value))
+
+def with_tiebreak(sort_spec, fields=("_id",)):
+    """sort_spec followed by the given fields (ascending) it doesn't sort on yet, so ties have one order."""
+    sorted_fields = {field for field, _ in sort_spec}
+    return list(sort_spec) + [(field, 1) for field in fields if field not in sorted_fields]
+
+def fetch_projection(projection, sort_spec):
+    """
+    (projection to fetch with, fields to strip afterwards), so the documents of
+    a projection still carry the sort fields the merge compares.
+    """
+    if not projection or not sort_spec:
+        return projection, set()
+    inclusion = any(v for k, v in projection.items() if k != "_id")
+    fetch = dict(projection)
+    extra = set()
+    for field, _ in sort_spec:
+        if field in fetch and not fetch[field]:
+            # Excluded (e.g. "_id": 0), fetch it anyway
+            del fetch[field]
+            extra.add(field)
+        elif inclusion and field not in fetch and field != "_id":
+            fetch[field] = 1
+            extra.add(field)
+    return fetch, extra
+
+class MergeKey:
+    """Orders documents by a sort spec with mixed directions."""
+    __slots__ = ("values", "directions")
+
+    def __init__(self, document, sort_spec):
+        self.values = [bson_sort_value(field_value(document, field)) for field, _ in sort_spec]
+        self.directions = [direction for _, direction in sort_spec]
+
+    def __lt__(self, other):
+        for mine, theirs, direction in zip(self.values, other.values, self.directions):
+            if mine != theirs:
+                return mine < theirs if direction > 0 else mine > theirs
+        return False
+
+    def __eq__(self, other):
+        # Lets heapq.merge fall back to its stable order for fully tied keys
+        return self.values == other.values
+
+class ShardedFind:
+    """
+    Iterates the documents of a find over several shards. After (partly) consuming
+    it, next_cursor() returns a token to continue from there, or None when done.
+    """
+
+    def __init__(self, shards, targets, collection_name, filter_query,
+                 projection=None, sort=None, limit=None, skip=0, cursor=None, batch_size=PAGE_SIZE):
+        self.shards = shards
+        self.targets = list(targets)
+        self.collection_name = collection_name
+        self.filter_query = filter_query
+        # _id breaks ties on the shards and in the merge, so resuming with a per-shard skip is exact
+        self.sort_spec = with_tiebreak(parse_sort(sort)) if sort else []
+        self.projection = parse_projection(projection)
+        self.batch_size = batch_size
+        self.skip = int(skip or 0)
+        self.limit = int(limit) if limit is not None else None
+        self.offsets = {shard: 0 for shard in self.targets}
+        if cursor:
+            offsets, self.limit = decode_cursor(cursor)
+            self.offsets.update({shard: offsets.get(shard, 0) for shard in self.targets})
+            self.skip = 0
+        self.exhausted = False
+
+    def _open_cursor(self, shard, projection):
+        cursor = self.shards[shard][self.collection_name].find(self.filter_query, projection)
+        if self.sort_spec:
+            cursor = cursor.sort(self.sort_spec)
+        if self.offsets[shard]:
+            cursor = cursor.skip(self.offsets[shard])
+        if self.limit is not None:
+            cursor = cursor.limit(self.skip + self.limit)
+        return cursor.batch_size(self.batch_size)
+
+    def _shard_stream(self, shard, first, cursor):
+        if first is None:
+            return
+        yield shard, first
+        for document in cursor:
+            yield shard, document
+
+    def __iter__(self):
+        if self.limit is not None and self.limit <= 0:
+            self.exhausted = True
+            return
+
+        projection, extra_fields = fetch_projection(self.projection, self.sort_spec)
+        cursors = {shard: self._open_cursor(shard, projection) for shard in self.targets}
+
+        # Fetch the first batch of every shard concurrently
+        firsts = scatter_gather({shard: (lambda c=cursor: next(c, None)) for shard, cursor in cursors.items()})
+        streams = [self._shard_stream(shard, firsts.get(shard), cursors[shard]) for shard in self.targets]
+
+        if self.sort_spec:
+            sort_spec = self.sort_spec
+            merged = heapq.merge(*streams, key=lambda item: MergeKey(item[1], sort_spec))
+        else:
+            merged = chain(*streams)
+
+        try:
+            skipped = 0
+            for shard, document in merged:
+                self.offsets[shard] += 1
+                if skipped < self.skip:
+                    skipped += 1
+                    continue
+                for field in extra_fields:
+                    document.pop(field, None)
+                if self.limit is not None:
+                    self.limit -= 1
+                yield document
+                if self.limit is not None and self.limit <= 0:
+                    break
+            else:
+                self.exhausted = True
+        finally:
+            for cursor in cursors.values():
+                cursor.close()
+
+    def next_cursor(self):
+        if self.exhausted or (self.limit is not None and self.limit <= 0):
+            return None
+        return encode_cursor(self.offsets, self.limit)
@@ -1,39 +1,51 @@
 import os
-from pymongo import MongoClient
+import time
+from concurrent.futures import ThreadPoolExecutor
+from utils.connections import get_client
 import gridfs
 from PIL import Image
 import mimetypes
+import json
+from utils.data_generation import MEDIA_MANIFEST
+from utils.media_store import (
+    ensure_alias_index,
+    existing_blobs,
+    existing_filenames,
+    count_media,
+    hash_file,
+    put_blob,
+    put_media,
+    media_exists,
+    alias_document,
+    ALIAS_COLLECTION,
+)
 
 # MongoDB connection details
-MONGO_URI = "mongodb://localhost:27041"
 DATABASE_NAME = "UnifiedDB"
 ARTICLES_DIR_PATH = "data/database/articles"  # Path containing article directories
+UPLOAD_WORKERS = 8  # Threads uploading files concurrently during bulk upload
 
-# Helper: Connect to MongoDB and get GridFS bucket
+# Helper: Connect to MongoDB (through the shared GFS client) and get GridFS bucket
 def connect_to_db():
-    client = MongoClient(MONGO_URI)
+    client = get_client("GFS")
     db = client[DATABASE_NAME]
     bucket = gridfs.GridFS(db)
     return db, bucket
 
-# Upload files to GridFS and link to articles
-def upload_files_to_gridfs(dir, db, bucket):
-    if not os.path.exists(dir):
-        print(f"Directory {dir} doesn't exist.")
-        return
-
-    fs = [f for f in os.listdir(dir) if os.path.isfile(os.path.join(dir, f))]
-    if not fs:
-        print(f"No files found in {dir}.")
-        return
-
-    for fname in fs:
-        fpath = os.path.join(dir, fname)
-        with open(fpath, "rb") as file:
-            if bucket.exists({"filename": fname}):
-                pass #print(f"File {fname} already exists.")
-            else:
-                file_id = bucket.put(file, filename=fname)
+# Media files of an article directory, as filename -> path of the file holding its content
+def article_media_files(dir):
+    fs = {}
+    with os.scandir(dir) as entries:
+        for entry in entries:
+            if entry.is_file():
+                fs[entry.name] = entry.path
+
+    # Articles generated in manifest mode only point to blobs in the media store
+    if MEDIA_MANIFEST in fs:
+        with open(fs.pop(MEDIA_MANIFEST), "r") as manifest_file:
+            for fname, blob in json.load(manifest_file).items():
+                fs[fname] = os.path.join(dir, blob)
+    return fs
 
 # Function to upload new media
 def upload_new_media(file_path):
@@ -46,32 +58,89 @@ def upload_new_media(file_path):
     filename = os.path.basename(file_path)
 
     # Connect to GridFS
-    _, bucket = connect_to_db()
+    db, bucket = connect_to_db()
 
     # Check if file already exists in GridFS
-    if bucket.exists({"filename": filename}):
+    if media_exists(db, bucket, filename):
         print(f"File {filename} already exists in GridFS. Skipping upload.")
         return None
 
-    # Upload the file to GridFS
-    with open(file_path, "rb") as file:
-        file_id = bucket.put(file, filename=filename)
-        print(f"Uploaded {filename} to GridFS with file_id {file_id}")
-        return file_id
+    # Upload the file to GridFS (its content is only stored if no other file has it)
+    file_id = put_media(db, bucket, filename, file_path)
+    print(f"Uploaded {filename} to GridFS with file_id {file_id}")
+    return file_id
+
+# Number of media files stored in GridFS
+def count_media_files():
+    db, _ = connect_to_db()
+    return count_media(db)
 
 # Process all article directories for bulk media upload
-def bulk_upload_articles():
+#   The existing filenames and blobs are fetched once and the articles directory is walked once.
+#   The files are hashed (once per inode) and every distinct content is uploaded once,
+#   both by a thread pool sharing one client, and the filenames are stored as aliases of those blobs
+def bulk_upload_articles(articles_dir=None, workers=UPLOAD_WORKERS):
+    articles_dir = articles_dir or ARTICLES_DIR_PATH
     db, bucket = connect_to_db()
-    debug_counter = 0
-    for article_dir in os.listdir(ARTICLES_DIR_PATH):
-        article_path = os.path.join(ARTICLES_DIR_PATH, article_dir)
-        if os.path.isdir(article_path):
-            upload_files_to_gridfs(article_path, db, bucket)
-        
-        debug_counter += 1
-        if debug_counter % 100 == 0:
-            print(f"Uploaded media for {debug_counter}/{len(os.listdir(ARTICLES_DIR_PATH))} articles.")
-    
+    ensure_alias_index(db)
+    existing = existing_filenames(db)
+    blobs = existing_blobs(db)
+
+    # Hardlinked, symlinked and manifest media share their inode, so each content is hashed once
+    pending_files = []
+    inode_paths = {}
+    with os.scandir(articles_dir) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                for fname, fpath in article_media_files(entry.path).items():
+                    if fname not in existing:
+                        stat = os.stat(fpath)
+                        inode = (stat.st_dev, stat.st_ino)
+                        inode_paths.setdefault(inode, fpath)
+                        pending_files.append((fname, inode))
+
+    def content_hash(item):
+        inode, fpath = item
+        return inode, (hash_file(fpath), os.path.getsize(fpath))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        hashes = dict(executor.map(content_hash, inode_paths.items()))
+
+    pending = []
+    missing_blobs = {}
+    for fname, inode in pending_files:
+        sha256, size = hashes[inode]
+        pending.append((fname, sha256, size))
+        if sha256 not in blobs:
+            missing_blobs[sha256] = inode_paths[inode]
+    print(f"{len(pending)} media files to upload ({len(missing_blobs)} new blobs), {len(existing)} already in GridFS.")
+
+    def upload(job):
+        sha256, fpath = job
+        return sha256, put_blob(bucket, sha256, fpath), os.path.getsize(fpath)
+
+    start = time.time()
+    uploaded_blobs = 0
+    uploaded_bytes = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for sha256, blob_id, size in executor.map(upload, missing_blobs.items()):
+            blobs[sha256] = blob_id
+            uploaded_blobs += 1
+            uploaded_bytes += size
+            if uploaded_blobs % 1000 == 0:
+                print(f"Uploaded {uploaded_blobs}/{len(missing_blobs)} blobs.")
+
+    aliases = [alias_document(fname, blobs[sha256], sha256, size) for fname, sha256, size in pending]
+    for i in range(0, len(aliases), 5000):
+        db[ALIAS_COLLECTION].insert_many(aliases[i:i + 5000], ordered=False)
+
+    duration = time.time() - start
+    megabytes = uploaded_bytes / (1024 * 1024)
+    logical_megabytes = sum(size for _, _, size in pending) / (1024 * 1024)
+    rate = megabytes / duration if duration > 0 else 0
+    print(f"Uploaded {len(pending)} media files ({logical_megabytes:.1f} MB) as {len(missing_blobs)} blobs "
+          f"({megabytes:.1f} MB) in {duration:.2f}s ({rate:.1f} MB/s).")
+    return len(pending)
 
 # Main entry point
 if __name__ == "__main__":
@@ -0,0 +1,93 @@
+import threading
+from collections import OrderedDict
+
+# Users cached by the directory (least recently used ones are evicted)
+USER_DIRECTORY_SIZE = 100000
+
+USER_PROJECTION = {"_id": 0, "uid": 1, "region": 1}
+
+class UserDirectory:
+    """
+    Bounded cache of uid -> region, backed by the User collections of both DBMS.
+
+    Reads are routed by the region of their user, so every Read insert needs
+    this lookup. The cache is warmed at startup, misses are fetched in one
+    $in query per DBMS for a whole batch, and entries are invalidated when a
+    User is inserted, updated or deleted through dbms_utils.
+    """
+
+    def __init__(self, max_size=USER_DIRECTORY_SIZE):
+        self.max_size = max_size
+        self._regions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._regions)
+
+    def _put(self, uid, region):
+        # Caller holds the lock
+        self._regions[uid] = region
+        self._regions.move_to_end(uid)
+        while len(self._regions) > self.max_size:
+            self._regions.popitem(last=False)
+
+    def put(self, uid, region):
+        with self._lock:
+            self._put(uid, region)
+
+    def invalidate(self, uids=None):
+        """Forget the given uids, or every uid if none are given."""
+        with self._lock:
+            if uids is None:
+                self._regions.clear()
+                return
+            for uid in uids:
+                self._regions.pop(uid, None)
+
+    def warm(self, dbms1_db, dbms2_db):
+        """Load uid -> region from both User collections, up to the cache size. Returns the number loaded."""
+        loaded = 0
+        with self._lock:
+            for db in (dbms1_db, dbms2_db):
+                cursor = db["User"].find({}, USER_PROJECTION).limit(self.max_size - loaded)
+                for user in cursor:
+                    if "uid" in user and "region" in user:
+                        self._put(user["uid"], user["region"])
+                        loaded += 1
+                if loaded >= self.max_size:
+                    break
+        return loaded
+
+    def lookup_many(self, dbms1_db, dbms2_db, uids):
+        """
+        uid -> region for the given uids. Cache misses are fetched with one
+        query per DBMS. Unknown uids are left out of the result.
+        """
+        regions = {}
+        missing = []
+        with self._lock:
+            for uid in set(uids):
+                if uid in self._regions:
+                    self._regions.move_to_end(uid)
+                    regions[uid] = self._regions[uid]
+                else:
+                    missing.append(uid)
+
+        if missing:
+            fetched = {}
+            for db in (dbms1_db, dbms2_db):
+                for user in db["User"].find({"uid": {"$in": missing}}, USER_PROJECTION):
+                    fetched[user["uid"]] = user.get("region")
+            with self._lock:
+                for uid, region in fetched.items():
+                    self._put(uid, region)
+            regions.update(fetched)
+
+        return regions
+
+    def lookup(self, dbms1_db, dbms2_db, uid):
+        """Region of a single user, or None if the user doesn't exist."""
+        return self.lookup_many(dbms1_db, dbms2_db, [uid]).get(uid)
+
+# Directory shared by the whole process
+user_directory = UserDirectory()